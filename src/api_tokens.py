@@ -0,0 +1,246 @@
+import asyncio
+import binascii
+import hashlib
+import hmac
+import os
+import time
+from collections import OrderedDict
+
+import rethinkdb as r
+from logzero import logger
+
+import changefeed
+import rdb_conn
+from permissions.compiled import flatten
+
+API_TOKEN_KEY = os.environ.get('API_TOKEN_KEY', '').encode()
+PREFIX = 'cion_'
+TABLE = 'api_tokens'
+MISS_TTL = 5
+MAX_MISSES = 1000
+
+# Without a key anyone could compute the digest of a secret, so api tokens
+# can neither be created nor used.
+ENABLED = bool(API_TOKEN_KEY)
+if not ENABLED:
+    logger.error('API_TOKEN_KEY is not set, api tokens are disabled')
+
+tokens = {}
+misses = OrderedDict()
+tokens_feed = None
+
+
+def generate():
+    """
+    Generates a new api token. The token is *cion_<id>.<secret>*; only the
+    id and a keyed hash of the secret are stored.
+
+    :return: token id, secret and the full token
+    """
+    token_id = binascii.hexlify(os.urandom(8)).decode()
+    secret = binascii.hexlify(os.urandom(32)).decode()
+    return token_id, secret, f'{PREFIX}{token_id}.{secret}'
+
+
+def digest(secret):
+    """
+    Hashes a token secret with ``API_TOKEN_KEY``. Secrets are long and
+    random, so a single keyed hash is enough to store them safely, and
+    checking a token costs microseconds instead of a password hash.
+
+    :param secret: the secret part of a token
+    :return: hex digest
+    """
+    return hmac.new(API_TOKEN_KEY, secret.encode(), hashlib.sha256).hexdigest()
+
+
+def parse(token):
+    """
+    :param token: an api token
+    :return: token id and secret, or None and None if it is malformed
+    """
+    if not token or not token.startswith(PREFIX) or '.' not in token:
+        return None, None
+    token_id, secret = token[len(PREFIX):].split('.', 1)
+    return token_id, secret
+
+
+def from_request(request):
+    """
+    Returns the api token given in the *Authorization: Bearer* or the
+    *X-API-Token* header of a request.
+
+    :param request: aiohttp request object
+    :return: the token, or None
+    """
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        return authorization[len('Bearer '):].strip()
+    return request.headers.get('X-API-Token')
+
+
+# -- cache
+
+def watch_tokens():
+    """
+    Subscribes to changes of the api tokens table, which keeps the cached
+    tokens up to date, if not already subscribed.
+    """
+    global tokens_feed
+    if tokens_feed is None:
+        tokens_feed = changefeed.hub.subscribe(TABLE, on_token_change,
+                                               on_tokens_feed_end,
+                                               on_tokens_feed_end)
+
+
+def on_token_change(change, seq):
+    """
+    Updates or removes the cached token a change is about.
+
+    :param change: changefeed change document
+    :param seq: sequence number of the change
+    """
+    row = change['new_val']
+    if row is None:
+        tokens.pop(change['old_val']['id'], None)
+    else:
+        cache(row)
+
+
+def on_tokens_feed_end(error=None):
+    global tokens_feed
+    tokens_feed = None
+    tokens.clear()
+    logger.warn(f'Api tokens changefeed ended: {error}. Resubscribing.')
+    asyncio.get_event_loop().call_later(1, watch_tokens)
+
+
+def cache(row):
+    row['permission-set'] = flatten(row['permissions'])
+    tokens[row['id']] = row
+    misses.pop(row['id'], None)
+
+
+async def lookup(token_id):
+    """
+    Fetches a token row, from memory if it is cached. Ids without a row
+    are remembered for ``MISS_TTL`` seconds, so made up tokens do not cost
+    a database lookup each.
+
+    :param token_id: id of the token
+    :return: the row, or None
+    """
+    watch_tokens()
+
+    row = tokens.get(token_id)
+    if row is not None:
+        return row
+
+    now = time.time()
+    missed = misses.get(token_id)
+    if missed is not None and now - missed < MISS_TTL:
+        return None
+
+    row = await rdb_conn.conn.run(
+        rdb_conn.conn.db().table(TABLE).get(token_id))
+    if row is None:
+        misses[token_id] = now
+        misses.move_to_end(token_id)
+        while len(misses) > MAX_MISSES:
+            misses.popitem(last=False)
+        return None
+
+    cache(row)
+    return row
+
+
+async def find_session(token):
+    """
+    Verifies an api token and returns a session-like object for it, with
+    the permission tree of the token instead of the owner's.
+
+    :param token: an api token
+    :return: the session, or None if the token is not valid
+    """
+    if not ENABLED:
+        return None
+
+    token_id, secret = parse(token)
+    if token_id is None:
+        return None
+
+    row = await lookup(token_id)
+    if row is None or not hmac.compare_digest(digest(secret), row['digest']):
+        return None
+    if row.get('expires') and row['expires'] < time.time():
+        return None
+
+    return {'user': {'username': row['owner'],
+                     'permissions': row['permissions']},
+            'permission-set': row['permission-set'],
+            'api-token': token_id}
+
+
+# -- database funcs
+
+async def db_create_token(name, owner, permissions, expires_in=None):
+    """
+    Creates an api token.
+
+    :param name: a name describing what the token is for
+    :param owner: username of the user creating the token
+    :param permissions: permission tree of the token
+    :param expires_in: seconds until the token expires, or None
+    :return: the token, which is not stored and cannot be shown again, and
+        the database response
+    """
+    token_id, secret, token = generate()
+    now = time.time()
+    db_res = await rdb_conn.conn.run(rdb_conn.conn.db().table(TABLE).insert({
+        'id': token_id,
+        'name': name,
+        'owner': owner,
+        'digest': digest(secret),
+        'permissions': permissions,
+        'created': now,
+        'expires': now + expires_in if expires_in else None
+    }))
+    return token, db_res
+
+
+async def db_get_tokens():
+    """
+    :return: all api tokens, without their digests
+    """
+    return await rdb_conn.conn.run(rdb_conn.conn.db()
+                                   .table(TABLE)
+                                   .without('digest')
+                                   .order_by(r.desc('created')))
+
+
+async def db_revoke_user_tokens(owner):
+    """
+    Deletes every api token of a user, so the tokens of a deleted user stop
+    working with it.
+
+    :param owner: username of the user
+    :return: database response
+    """
+    for token_id in [token_id for token_id, row in tokens.items()
+                     if row['owner'] == owner]:
+        del tokens[token_id]
+    return await rdb_conn.conn.run(
+        rdb_conn.conn.db().table(TABLE).filter({'owner': owner}).delete())
+
+
+async def db_revoke_token(token_id):
+    """
+    Deletes an api token. Other replicas drop it from their cache through
+    the changefeed.
+
+    :param token_id: id of the token
+    :return: database response
+    """
+    tokens.pop(token_id, None)
+    return await rdb_conn.conn.run(
+        rdb_conn.conn.db().table(TABLE).get(token_id).delete())
@@ -1,5 +1,8 @@
 from aiohttp import web
 
+import changefeed
+import counts
+import indexes
 import rdb_conn
 import websocket
 from services import get_service, delete_service, get_running_image, \
@@ -8,10 +11,12 @@ from documents import get_documents, set_document, get_document, \
     get_permission_def
 from tasks import get_tasks, create_task, get_recent_tasks, get_task, \
     schedule_deploy
-from auth import api_auth, api_create_user, logout, verify_token
+from auth import api_auth, api_create_user, logout, verify_token, \
+    get_session_stats
 from cion_system import get_health
 from user import set_gravatar_email, get_users, delete_user, change_password, \
-    get_permissions, set_permissions, change_own_password
+    get_permissions, set_permissions, change_own_password, create_api_token, \
+    get_api_tokens, revoke_api_token, check_permissions
 from environments import get_environments, create_environment
 from webhooks import create_webhook, get_webhooks, get_webhook, delete_webhook
 
@@ -38,15 +43,36 @@ if __name__ == '__main__':
                               os.path.join(static_path, 'resources'))
 
     rdb_conn.init()
-
-    ws_route = websocket.create(rdb_conn.conn)
-
-    app.router.add_get('/api/v1/socket', ws_route)
+    indexes.init()
+
+    hub = changefeed.init(rdb_conn.conn)
+    counts.init()
+    socket = websocket.create(hub)
+
+    app.router.add_get('/api/v1/socket', socket.handle_request)
+    app.router.add_get('/api/v1/socket/clients', websocket.get_clients)
+
+    socket.add_query('users', get_users)
+    socket.add_query('tasks', get_tasks)
+    socket.add_query('tasks/recent', get_recent_tasks)
+    socket.add_query('task', get_task)
+    socket.add_query('environments', get_environments)
+    socket.add_query('webhooks', get_webhooks)
+    socket.add_query('webhook', get_webhook)
+    socket.add_query('documents', get_documents)
+    socket.add_query('document', get_document)
+    socket.add_query('permissions/permission-def', get_permission_def)
+    socket.add_query('permissions/user', get_permissions)
+    socket.add_query('permissions/check', check_permissions)
+    socket.add_query('services', get_services)
+    socket.add_query('service/image', get_running_image)
+    socket.add_query('service', get_service)
 
     app.router.add_post('/api/v1/auth', api_auth)
     app.router.add_get('/api/v1/verify-session', verify_token)
     app.router.add_post('/api/v1/create/user', api_create_user)
     app.router.add_post('/api/v1/logout', logout)
+    app.router.add_get('/api/v1/sessions/stats', get_session_stats)
 
     app.router.add_post('/api/v1/user/setgravataremail', set_gravatar_email)
     app.router.add_put('/api/v1/user/setpassword', change_own_password)
@@ -54,6 +80,10 @@ if __name__ == '__main__':
     app.router.add_put('/api/v1/user/{name}/setpassword', change_password)
     app.router.add_delete('/api/v1/user/{name}', delete_user)
 
+    app.router.add_get('/api/v1/api-tokens', get_api_tokens)
+    app.router.add_post('/api/v1/api-tokens', create_api_token)
+    app.router.add_delete('/api/v1/api-token/{id}', revoke_api_token)
+
     app.router.add_get('/api/v1/tasks', get_tasks)
     app.router.add_get('/api/v1/tasks/recent', get_recent_tasks)
     app.router.add_get('/api/v1/task/{id}', get_task)
@@ -77,6 +107,7 @@ if __name__ == '__main__':
                        get_permission_def)
     app.router.add_get('/api/v1/permissions/user/{username}', get_permissions)
     app.router.add_put('/api/v1/permissions/user/{username}', set_permissions)
+    app.router.add_post('/api/v1/permissions/check', check_permissions)
 
     app.router.add_get('/api/v1/services', get_services)
     app.router.add_post('/api/v1/services/create', create_service)
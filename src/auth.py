@@ -5,25 +5,111 @@ import json
 import os
 import random
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from functools import wraps
 
 import rethinkdb as r
 from aiohttp import web
+from logzero import logger
 
+import api_tokens
+import changefeed
 import rdb_conn
-from permissions.permission import perm
+from permissions.compiled import perm, permission_set
+from session_store import SessionStore
 
-sessions = {}
+HASH_POOL = os.environ.get('HASH_POOL', 'thread')
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', '4'))
+HASH_MAX_PENDING = int(os.environ.get('HASH_MAX_PENDING', '32'))
+HASH_QUEUE_TIMEOUT = float(os.environ.get('HASH_QUEUE_TIMEOUT', '5'))
+
+sessions = SessionStore()
+users_feed = None
+
+hash_executor = None
+hash_slots = None
+
+
+class HashPoolBusy(Exception):
+    """
+    Raised when a hash could not be admitted to the hashing pool in time.
+    """
 
 
 # util funcs
 
 # -- sessions
 
+def watch_users():
+    """
+    Subscribes to the process-wide changefeed on the users table, which
+    keeps the user object of every session up to date, if not already
+    subscribed.
+    """
+    global users_feed
+    if users_feed is None:
+        users_feed = changefeed.hub.subscribe('users', on_user_change,
+                                              on_users_feed_end,
+                                              on_users_feed_end,
+                                              on_ready=on_users_feed_ready)
+
+
+def on_user_change(change, seq):
+    """
+    Updates the sessions of the user a users table change is about. A
+    deleted user's sessions are invalidated and api tokens revoked.
+
+    :param change: changefeed change document
+    :param seq: sequence number of the change
+    """
+    user = change['new_val']
+    if user is None:
+        username = change['old_val']['username']
+        invalidate_sessions(username)
+        asyncio.ensure_future(api_tokens.db_revoke_user_tokens(username))
+        return
+
+    sessions.update_user(user)
+
+
+def on_users_feed_ready():
+    asyncio.ensure_future(reload_users())
+
+
+async def reload_users():
+    """
+    Re-reads the users that have sessions in memory, catching up on the
+    changes made while the users changefeed was not open. Sessions of users
+    that are gone are invalidated. If the users cannot be read, their
+    sessions are evicted from memory instead.
+    """
+    usernames = set(sessions.user_tokens)
+    if not usernames:
+        return
+
+    try:
+        users = await rdb_conn.conn.list(
+            rdb_conn.conn.db().table('users').get_all(*usernames))
+    except r.errors.ReqlError as e:
+        logger.warn(f'Could not reload users: {e}')
+        for username in usernames:
+            sessions.evict_user(username)
+        return
+
+    for user in users:
+        usernames.discard(user['username'])
+        sessions.update_user(user)
+
+    for username in usernames:
+        invalidate_sessions(username)
+        asyncio.ensure_future(api_tokens.db_revoke_user_tokens(username))
 
-async def watch_user(query, token):
-    async for change in rdb_conn.conn.iter(query.changes()):
-        sessions[token]['user'] = change['new_val']
+
+def on_users_feed_end(error=None):
+    global users_feed
+    users_feed = None
+    logger.warn(f'Users changefeed ended: {error}. Resubscribing.')
+    asyncio.get_event_loop().call_later(1, watch_users)
 
 
 def validate_password(password):
@@ -32,7 +118,7 @@ def validate_password(password):
     return True, "Password is valid"
 
 
-def create_session(user):
+async def create_session(user):
     """
     Creates a session for the given user and returns a generated session token.
 
@@ -40,16 +126,58 @@ def create_session(user):
     :return: The generated session-token
     """
     token = binascii.hexlify(os.urandom(64)).decode()
-    sessions[token] = {}
-    sessions[token]['user'] = user
+    sessions.add(token, user)
+    await sessions.persist(token)
 
-    q = r.db(rdb_conn.conn.db_name).table('users').get(user['username'])
-    task = asyncio.ensure_future(watch_user(q, token))
-    sessions[token]['task'] = task
+    watch_users()
 
     return token
 
 
+async def find_session(token):
+    """
+    Finds the session of a token. Sessions not in memory are loaded from
+    the session backend, so a token created by another replica is valid
+    here too.
+
+    :param token: session token
+    :return: the session, or None if the token has no live session
+    """
+    session = await sessions.load(token)
+    if session is not None:
+        watch_users()
+    return session
+
+
+async def authenticate(request):
+    """
+    Finds the session of a request. The session token in the
+    *X-CSRF-Token* header is tried first, then an api token.
+
+    :param request: aiohttp request object
+    :return: the session, or None if the request carries no valid token
+    """
+    token = request.headers.get('X-CSRF-Token')
+    if token:
+        return await find_session(token)
+
+    api_token = api_tokens.from_request(request)
+    if api_token:
+        return await api_tokens.find_session(api_token)
+
+    return None
+
+
+def remove_session(token):
+    """
+    Removes the session of the given token.
+
+    :param token: session token
+    :return: the removed session, or None if there was no such session
+    """
+    return sessions.pop(token)
+
+
 def retrieve_session(request):
     """
     Retrieves the stored session object stored on the session token contained
@@ -58,6 +186,8 @@ def retrieve_session(request):
     :param request: The aiohttp request object that contains the session token
     :return: The session user object
     """
+    if 'session' in request:
+        return request['session']
     token = request.headers.get('X-CSRF-Token')
     return sessions[token]
 
@@ -68,11 +198,7 @@ def invalidate_sessions(username):
 
     :param username: username
     """
-    for token in list(sessions.keys()):
-        session = sessions[token]
-        if username == session['user']['username']:
-            sessions.pop(token)
-            session['task'].cancel()
+    sessions.pop_user(username)
 
 
 # -- hashing
@@ -105,6 +231,55 @@ def hash_str(to_hash: str, salt, iterations):
                                128)
 
 
+async def hash_str_async(to_hash: str, salt, iterations):
+    """
+    Like :func:`hash_str`, but runs the hash function in a worker pool so it
+    does not block the event loop.
+
+    At most ``HASH_MAX_PENDING`` hashes are queued or running at a time.
+    Callers that cannot be admitted within ``HASH_QUEUE_TIMEOUT`` seconds
+    get a :class:`HashPoolBusy` error.
+
+    :param to_hash: The string to hash
+    :param salt: Salt to use in the hash function
+    :param iterations: number of iterations to use in the hash function
+    :raises HashPoolBusy: if the pool is too busy
+    :return: the hash
+    """
+    global hash_executor, hash_slots
+    if hash_executor is None:
+        executor_type = ProcessPoolExecutor if HASH_POOL == 'process' \
+            else ThreadPoolExecutor
+        hash_executor = executor_type(max_workers=HASH_WORKERS)
+        hash_slots = asyncio.Semaphore(HASH_MAX_PENDING)
+
+    try:
+        await asyncio.wait_for(hash_slots.acquire(), HASH_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HashPoolBusy()
+
+    try:
+        return await asyncio.get_event_loop().run_in_executor(
+            hash_executor, hash_str, to_hash, salt, iterations)
+    finally:
+        hash_slots.release()
+
+
+async def create_hash_async(to_hash: str):
+    """
+    Like :func:`create_hash`, but hashes in a worker pool, see
+    :func:`hash_str_async`.
+
+    :param to_hash: the string to hash
+    :raises HashPoolBusy: if the pool is too busy
+    :return: hash and salt as bytes, iterations as int
+    """
+    iterations = random.randint(20000, 25000)
+    salt = os.urandom(32)
+    hash_created = await hash_str_async(to_hash, salt, iterations)
+    return hash_created, salt, iterations
+
+
 # fixme: Find out if used at all. Remove if not
 def has_permission(permission_tree, path):
     """
@@ -138,18 +313,33 @@ def bad_creds_response():
                         content_type='application/json')
 
 
-def forbidden_response(error_msg):
+def busy_response():
     """
-    Creates and returns a  403 forbidden response with the given error msg
-    contained in the body.
+    Creates and returns a 503 http response for when the hashing pool is
+    too busy to take more work.
 
-    :param error_msg: The message to put in the response
+    :return: The generated 503 http response
+    """
+    return web.Response(status=503,
+                        text='{"error": "Server is busy, try again later"}',
+                        content_type='application/json')
+
+
+def forbidden_response(missing):
+    """
+    Creates and returns a  403 forbidden response listing the missing
+    permission paths in the body.
+
+    :param missing: The missing permission paths
     :return: The generated 403 http response
     """
     return web.Response(status=403,
-                        text='{"error": "You don\'t have the correct '
-                             'permissions to perform this action. Missing: '
-                             f'{error_msg.join(",")}"}}',
+                        text=json.dumps({
+                            'error': 'You don\'t have the correct '
+                                     'permissions to perform this action. '
+                                     f'Missing: {", ".join(missing)}',
+                            'missing': missing
+                        }),
                         content_type='application/json')
 
 
@@ -158,6 +348,10 @@ def requires_auth(func=None, permission_expr=None):
     A decorator to use on aiohttp endpoints to run authentication on all
     requests before calling the endpoint function.
 
+    Compiled permission expressions, see :mod:`permissions.compiled`, are
+    checked against the flattened permissions of the session, others
+    against the user's permission tree.
+
     :param func: The function to wrap
     :param permission_expr: The permission expression to check
     :return: The decorated function
@@ -165,24 +359,29 @@ def requires_auth(func=None, permission_expr=None):
     if func:
         permission_expr = None
 
-    error_msg = ""
-
-    def error_fn(error_reason):
-        nonlocal error_msg
-        error_msg = error_reason
-
     def decorator(f):
         @wraps(f)
         async def wrapper(request):
-            token = request.headers.get('X-CSRF-Token')
-            if token not in sessions:
+            session = await authenticate(request)
+            if not session:
                 return bad_creds_response()
-            user = sessions[token]['user']
-            if permission_expr \
-                    and ('permissions' not in user
-                         or not await permission_expr.has_permission(
-                            user['permissions'], error_fn, request)):
-                return forbidden_response(error_msg)
+            request['session'] = session
+            user = session['user']
+            if not permission_expr:
+                return await f(request)
+
+            missing = []
+            if getattr(permission_expr, 'compiled', False):
+                permissions = permission_set(session)
+            elif 'permissions' in user:
+                permissions = user['permissions']
+            else:
+                return forbidden_response(missing)
+
+            if not await permission_expr.has_permission(permissions,
+                                                        missing.append,
+                                                        request):
+                return forbidden_response(missing)
             return await f(request)
 
         return wrapper
@@ -200,9 +399,10 @@ async def db_create_user(username, password, permissions):
     :param username: Username for the user
     :param password: Password in plain-text for the user
     :param permissions: The permission-tree for the user.
+    :raises HashPoolBusy: if the hashing pool is too busy
     :return: Database response
     """
-    pw_hash, salt, iterations = create_hash(password)
+    pw_hash, salt, iterations = await create_hash_async(password)
 
     db_res = await rdb_conn.conn.run(rdb_conn.conn.db().table('users').insert({
         "username": username,
@@ -261,7 +461,10 @@ async def api_create_user(request):
     else:
         permissions = bod['permissions']
 
-    db_res = await db_create_user(username, password, permissions)
+    try:
+        db_res = await db_create_user(username, password, permissions)
+    except HashPoolBusy:
+        return busy_response()
 
     if 'errors' in db_res and db_res['errors']:
         if db_res['first_error'].find('Duplicate primary key') > -1:
@@ -304,11 +507,14 @@ async def api_auth(request):
     salt = user['salt']
     iterations = user['iterations']
     stored_hash = user['password_hash']
-    input_hash = hash_str(password, salt, iterations)
+    try:
+        input_hash = await hash_str_async(password, salt, iterations)
+    except HashPoolBusy:
+        return busy_response()
     if not input_hash == stored_hash:
         return bad_creds_response()
 
-    token = create_session(user)
+    token = await create_session(user)
 
     if 'gravatar-email' not in user or not user['gravatar-email']:
         gravatar_email = ''
@@ -345,7 +551,7 @@ async def verify_token(request):
     :return: 200 if valid token, 401 otherwise
     """
     token = request.headers.get('X-CSRF-Token')
-    if token in sessions:
+    if await find_session(token):
         return web.Response(status=200)
     else:
         return bad_creds_response()
@@ -359,9 +565,8 @@ async def logout(request):
     :return: aiohttp web response object
     """
     token = request.headers.get('X-CSRF-Token')
-    session = sessions.pop(token, None)
+    session = remove_session(token)
     if session:
-        session['task'].cancel()
         return web.Response(status=200,
                             text=json.dumps({
                                 'message':
@@ -376,3 +581,16 @@ async def logout(request):
                                     'session'
                             }),
                             content_type='application/json')
+
+
+@requires_auth(permission_expr=perm('cion.view.config'))
+async def get_session_stats(request):
+    """
+    aiohttp endpoint to fetch session counts and memory use
+
+    :param request: aiohttp request object
+    :return: aiohttp response with session store stats
+    """
+    return web.Response(status=200,
+                        text=json.dumps(sessions.stats()),
+                        content_type='application/json')
@@ -0,0 +1,272 @@
+import asyncio
+import binascii
+import os
+from collections import defaultdict, deque
+
+from logzero import logger
+
+import search
+
+REPLAY_SIZE = int(os.environ.get('CHANGEFEED_REPLAY_SIZE', '1000'))
+
+hub: 'ChangefeedHub' = None
+
+
+def init(conn):
+    """
+    Creates the process-wide changefeed hub for the given connection.
+
+    :param conn: database connection object
+    :return: the created hub
+    """
+    global hub
+    hub = ChangefeedHub(conn)
+    return hub
+
+
+def feed_key(table, search_term=None):
+    """
+    Returns the key identifying the feed on a table filtered by a search
+    term. Unfiltered feeds are keyed by the table name alone.
+
+    :param table: name of the table
+    :param search_term: lucene search term, or None
+    :return: the feed key
+    """
+    search_term = (search_term or '').strip()
+    return (table, search_term) if search_term else table
+
+
+class Subscription:
+    """
+    A single subscriber to a shared changefeed. The callbacks are called
+    synchronously from the feed task and must not block. ``on_next`` is
+    called with the change document and its sequence number. ``on_ready``
+    is called once the database feed is open, from when on no change is
+    missed.
+    """
+
+    def __init__(self, feed, on_next, on_error=None, on_complete=None,
+                 on_ready=None):
+        self.feed = feed
+        self.on_next = on_next
+        self.on_error = on_error
+        self.on_complete = on_complete
+        self.on_ready = on_ready
+
+    def dispose(self):
+        """
+        Removes this subscriber from its feed. Closes the feed if this was
+        the last subscriber.
+        """
+        if self.feed:
+            self.feed.remove(self)
+            self.feed = None
+
+
+class Changefeed:
+    """
+    One database changefeed on a table, shared by any number of
+    subscribers.
+
+    Every change is numbered with the table's sequence, and the last
+    changes are kept in a bounded ring so subscribers that reconnect can be
+    sent what they missed.
+    """
+
+    def __init__(self, hub, key, table, query):
+        self.hub = hub
+        self.key = key
+        self.table = table
+        self.query = query
+        self.subscribers = set()
+        self.task = None
+        self.ready = False
+        self.ring = deque(maxlen=REPLAY_SIZE)
+        self.floor = 0
+
+    def start(self):
+        logger.debug(f'Opening changefeed {self.key}')
+        # Changes made while no feed was open are unknown, so nothing up to
+        # and including the floor can be replayed.
+        self.floor = self.hub.next_seq(self.table)
+        self.task = asyncio.ensure_future(self._run())
+
+    def replay(self, since):
+        """
+        Returns the changes after the given sequence number.
+
+        :param since: sequence number of the last change a subscriber got
+        :return: list of (sequence number, change) tuples, or None if the
+            ring no longer holds every change after ``since``
+        """
+        if since < self.floor or since > self.hub.sequences[self.table]:
+            return None
+        return [(seq, change) for seq, change in self.ring if seq > since]
+
+    def _record(self, change):
+        seq = self.hub.next_seq(self.table)
+        if len(self.ring) == self.ring.maxlen:
+            self.floor = self.ring[0][0]
+        self.ring.append((seq, change))
+        return seq
+
+    def add(self, subscription):
+        self.subscribers.add(subscription)
+
+    def remove(self, subscription):
+        self.subscribers.discard(subscription)
+        if not self.subscribers:
+            self.close()
+
+    def close(self):
+        """
+        Stops the database changefeed and forgets about it in the hub.
+        """
+        self._forget()
+        if self.task and not self.task.done():
+            logger.debug(f'Closing changefeed {self.key}')
+            self.task.cancel()
+
+    def _forget(self):
+        if self.hub.feeds.get(self.key) is self:
+            del self.hub.feeds[self.key]
+
+    def _notify(self, callback_name, *args):
+        for sub in list(self.subscribers):
+            callback = getattr(sub, callback_name)
+            if not callback:
+                continue
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception(f'Changefeed subscriber for {self.key} '
+                                 f'raised in {callback_name}')
+
+    async def _run(self):
+        try:
+            await self.hub.primary_key(self.table)
+            async for change in self.hub.conn.iter(
+                    self.query.changes(include_states=True)):
+                if 'state' in change:
+                    if change['state'] == 'ready':
+                        self.ready = True
+                        self._notify('on_ready')
+                    continue
+                self._notify('on_next', change, self._record(change))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warn(f'Changefeed {self.key} failed: {e}')
+            self._forget()
+            self._notify('on_error', e)
+        else:
+            self._forget()
+            self._notify('on_complete')
+
+
+class ChangefeedHub:
+    """
+    Multiplexes database changefeeds. At most one changefeed is open per
+    table and search term, no matter how many subscribers there are. The feed
+    is closed when the last subscriber leaves.
+
+    Sequence numbers are only meaningful within the hub's ``epoch``, which
+    is new every time the process starts.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.feeds = {}
+        self.primary_keys = {}
+        self.epoch = binascii.hexlify(os.urandom(8)).decode()
+        self.sequences = defaultdict(int)
+
+    def next_seq(self, table):
+        """
+        Advances the sequence of the given table.
+
+        :param table: name of the table
+        :return: the new sequence number
+        """
+        self.sequences[table] += 1
+        return self.sequences[table]
+
+    def replay(self, table, since, epoch, search_term=None):
+        """
+        Returns the changes a subscriber missed on an open feed.
+
+        :param table: name of the table
+        :param since: sequence number of the last change the subscriber got
+        :param epoch: epoch the sequence number belongs to
+        :param search_term: search term the feed is filtered by
+        :return: list of (sequence number, change) tuples, or None if the
+            missed changes are not known and the subscriber must resync
+        """
+        feed = self.feeds.get(feed_key(table, search_term))
+        if feed is None or epoch != self.epoch:
+            return None
+        return feed.replay(since)
+
+    async def primary_key(self, table):
+        """
+        Looks up, and caches, the name of the primary key of a table.
+
+        :param table: name of the table
+        :return: name of the primary key field
+        """
+        if table not in self.primary_keys:
+            self.primary_keys[table] = await self.conn.run(
+                self.conn.db().table(table).info()['primary_key'])
+        return self.primary_keys[table]
+
+    def subscribe(self, table, on_next, on_error=None, on_complete=None,
+                  search_term=None, on_ready=None):
+        """
+        Subscribes to changes on the given table. If a search term is given,
+        the feed is filtered by the database and only changes to documents
+        matching the term are delivered.
+
+        :param table: name of the table to watch
+        :param on_next: called with every change document
+        :param on_error: called with the exception if the feed fails
+        :param on_complete: called if the feed ends
+        :param search_term: lucene search term to filter the feed by
+        :param on_ready: called once the feed is open, right away if it
+            already is
+        :raises luqum.parser.ParseError: if the search term does not parse,
+            or has relative times, like *now-1h*; the filter of a feed is
+            compiled once, so their window would never move
+        :return: a :class:`Subscription`, call ``dispose`` to unsubscribe
+        """
+        key = feed_key(table, search_term)
+        feed = self.feeds.get(key)
+        if feed is None:
+            query = self.conn.db().table(table)
+            if key != table:
+                relative = search.relative_times(search.parse(key[1]))
+                if relative:
+                    raise search.ParseError(
+                        f'Relative times like {relative[0]} are not '
+                        f'supported in subscriptions')
+                query = query.filter(search.get_filter(key[1]))
+
+            feed = Changefeed(self, key, table, query)
+            self.feeds[key] = feed
+            feed.start()
+
+        subscription = Subscription(feed, on_next, on_error, on_complete,
+                                    on_ready)
+        feed.add(subscription)
+        if feed.ready and on_ready:
+            asyncio.get_event_loop().call_soon(on_ready)
+        return subscription
+
+    def subscriber_count(self, table, search_term=None):
+        """
+        :param table: name of the table
+        :param search_term: search term the feed is filtered by
+        :return: number of subscribers on the feed for the given table
+        """
+        feed = self.feeds.get(feed_key(table, search_term))
+        return len(feed.subscribers) if feed else 0
@@ -2,14 +2,18 @@ import json
 
 from aiohttp import web
 
+import indexes
+
 
 async def get_health(request):
     """
-    aiohttp endpoint to act as a healthcheck
+    aiohttp endpoint to act as a healthcheck. Reports the progress of the
+    indexes being built, see :func:`indexes.migrate`, by table and index.
 
     :param request: aiohttp request object
     :return: an aiohttp response object with http status code **200**.
     """
     return web.Response(status=200,
-                        text=json.dumps({'status': 'UP'}),
+                        text=json.dumps({'status': 'UP',
+                                         'indexes': indexes.building}),
                         content_type='application/json')
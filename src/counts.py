@@ -0,0 +1,204 @@
+import asyncio
+import os
+from collections import Counter
+
+import rethinkdb as r
+from logzero import logger
+
+import changefeed
+import rdb_conn
+
+SEED_ATTEMPTS = int(os.environ.get('COUNTS_SEED_ATTEMPTS', '5'))
+RESUBSCRIBE_DELAY = float(os.environ.get('COUNTS_RESUBSCRIBE_DELAY', '1'))
+RESEED_INTERVAL = float(os.environ.get('COUNTS_RESEED_INTERVAL', '600'))
+
+# Tables whose row counts are kept in memory, with the fields whose counts
+# per value are kept as well.
+COUNTED = {
+    'tasks': ['event', 'status', 'environment', 'service'],
+    'environments': [],
+    'webhooks': [],
+}
+
+tables = {}
+
+
+class TableCounts:
+    """
+    The row count of a table, and its row counts per value of some fields,
+    kept up to date from the table's changefeed.
+
+    The counts are seeded with a count query once the changefeed is open,
+    so every change after the seed is delivered. A change arriving while
+    seeding may or may not be part of the seed, so the seed is retried
+    until it ran without any change arriving. Until then, and after the
+    feed ends, the counts are unknown. They are seeded again every
+    ``RESEED_INTERVAL`` seconds, which corrects any drift.
+    """
+
+    def __init__(self, table_name, fields):
+        self.table_name = table_name
+        self.fields = list(fields)
+        self.total = None
+        self.values = {}
+        self.changes = 0
+        self.subscription = None
+        self.ready = False
+        self.seeding = None
+        self.reseeding = None
+
+    @property
+    def seeded(self):
+        return self.total is not None
+
+    def watch(self):
+        """
+        Subscribes to the changefeed of the table, if not already
+        subscribed, and seeds the counts if they are not known and not
+        being seeded.
+        """
+        if self.subscription is None:
+            self.subscription = changefeed.hub.subscribe(
+                self.table_name, self.on_change, self.on_end, self.on_end,
+                on_ready=self.on_ready)
+        elif not self.seeded:
+            self.start_seed()
+
+    def on_ready(self):
+        if self.subscription is None:
+            return
+        self.ready = True
+        self.start_seed()
+
+    def start_seed(self):
+        if self.ready and (self.seeding is None or self.seeding.done()):
+            self.seeding = asyncio.ensure_future(self.seed())
+
+    async def seed(self):
+        try:
+            await self.try_seed()
+        finally:
+            if self.seeded and self.subscription is not None:
+                self.reseeding = asyncio.get_event_loop().call_later(
+                    RESEED_INTERVAL, self.start_seed)
+
+    async def try_seed(self):
+        for _ in range(SEED_ATTEMPTS):
+            changes = self.changes
+            try:
+                total, values = await self.query()
+            except r.errors.ReqlError as e:
+                logger.warn(f'Could not count {self.table_name}: {e}')
+                return
+            if self.subscription is None:
+                return
+            if changes == self.changes:
+                self.total, self.values = total, values
+                logger.debug(f'Seeded counts of {self.table_name}: {total}')
+                return
+        logger.warn(f'Could not seed counts of {self.table_name}, it kept '
+                    f'changing')
+
+    async def query(self):
+        table = rdb_conn.conn.db().table(self.table_name)
+        result = await rdb_conn.conn.run(r.expr({
+            'total': table.count(),
+            'values': {field: table.group(field).count().ungroup()
+                       for field in self.fields}
+        }))
+        values = {field: Counter({countable(group['group']):
+                                  group['reduction'] for group in groups})
+                  for field, groups in result['values'].items()}
+        return result['total'], values
+
+    def on_change(self, change, seq):
+        self.changes += 1
+        if not self.seeded:
+            return
+
+        old, new = change.get('old_val'), change.get('new_val')
+        if old is not None:
+            self.total -= 1
+        if new is not None:
+            self.total += 1
+        for field, counter in self.values.items():
+            if old is not None:
+                counter[countable(old.get(field))] -= 1
+            if new is not None:
+                counter[countable(new.get(field))] += 1
+
+    def on_end(self, error=None):
+        logger.warn(f'Counts changefeed of {self.table_name} ended: {error}')
+        self.subscription = None
+        self.ready = False
+        self.total = None
+        self.values = {}
+        if self.reseeding is not None:
+            self.reseeding.cancel()
+            self.reseeding = None
+        asyncio.get_event_loop().call_later(RESUBSCRIBE_DELAY, self.watch)
+
+    def count(self, field=None, values=()):
+        """
+        :param field: a counted field, or None for the row count
+        :param values: values of the field to count the rows of
+        :return: the count, or None if it is not known
+        """
+        if not self.seeded:
+            return None
+        if field is None:
+            return self.total
+        counter = self.values.get(field)
+        if counter is None:
+            return None
+        return sum(counter[countable(value)] for value in set(values))
+
+
+def countable(value):
+    """
+    :param value: value of a field
+    :return: the value, as a key of the counts
+    """
+    if isinstance(value, list):
+        return tuple(countable(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, countable(item))
+                            for key, item in value.items()))
+    return value
+
+
+def init():
+    """
+    Starts counting every table in :data:`COUNTED`.
+    """
+    for table_name in COUNTED:
+        get(table_name).watch()
+
+
+def get(table_name):
+    """
+    :param table_name: name of the table
+    :return: the :class:`TableCounts` of the table, or None if it is not
+        counted
+    """
+    counts = tables.get(table_name)
+    if counts is None and table_name in COUNTED:
+        counts = tables[table_name] = TableCounts(table_name,
+                                                  COUNTED[table_name])
+    return counts
+
+
+def count(table_name, field=None, values=()):
+    """
+    Returns a count kept in memory, without querying the database.
+
+    :param table_name: name of the table
+    :param field: a counted field, or None for the row count
+    :param values: values of the field to count the rows of
+    :return: the count, or None if it is not kept or not known yet
+    """
+    counts = get(table_name)
+    if counts is None:
+        return None
+    counts.watch()
+    return counts.count(field, values)
@@ -8,7 +8,7 @@ import functools
 import asyncio
 
 from auth import requires_auth
-from permissions.permission import perm
+from permissions.compiled import perm
 
 def lazy(fn):
     """
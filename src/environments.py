@@ -1,7 +1,7 @@
 import rdb_conn
 from auth import requires_auth
 from documents import json
-from permissions.permission import perm
+from permissions.compiled import perm
 import rethinkdb as r
 
 import table
@@ -43,11 +43,8 @@ async def get_environments(request):
     response = await table.table_query(request, 'environments')
     if 'web-response' in response:
         return response['web-response']
-    else:
-        result = response['result']
-        count = response['count']
 
-    return json({'rows': result, 'totalLength': count})
+    return json(table.page_body(response))
 
 
 @requires_auth
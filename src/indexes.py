@@ -0,0 +1,271 @@
+import asyncio
+import os
+import time
+
+import rethinkdb as r
+from logzero import logger
+
+import rdb_conn
+
+REFRESH_INTERVAL = float(os.environ.get('INDEX_REFRESH_INTERVAL', '60'))
+PROGRESS_INTERVAL = float(os.environ.get('INDEX_PROGRESS_INTERVAL', '10'))
+
+
+class Index:
+    """
+    Declares a secondary index on one or more fields. An index on one
+    field is a simple index, on several fields a compound index, sorting by
+    the fields in order. A multi index is on a field holding an array, and
+    has an entry for every element. Nested fields are given as
+    period-separated paths.
+    """
+
+    def __init__(self, *fields, multi=False):
+        self.fields = list(fields)
+        self.multi = multi
+
+    def value(self, row):
+        """
+        :param row: rethinkdb row
+        :return: the rethinkdb expression of the indexed value of the row
+        """
+        values = [field_value(row, field) for field in self.fields]
+        return values[0] if len(values) == 1 else values
+
+    def create(self, table, name):
+        """
+        :param table: rethinkdb table
+        :param name: name of the index
+        :return: the rethinkdb query creating the index
+        """
+        if self.fields == [name]:
+            return table.index_create(name, multi=self.multi)
+        return table.index_create(name, lambda row: self.value(row),
+                                  multi=self.multi)
+
+
+def field_value(row, field):
+    """
+    :param row: rethinkdb row
+    :param field: period-separated path of a field
+    :return: the rethinkdb expression of the field of the row
+    """
+    for key in field.split('.'):
+        row = row[key]
+    return row
+
+
+# Secondary indexes, by table. A simple index on a top level field is named
+# after the field; a compound index is named after its fields, joined by
+# underscores, which is what the query planner looks for, see
+# :func:`declared`. Missing indexes are created at startup, see
+# :func:`migrate`.
+INDEXES = {
+    'tasks': {
+        'time': Index('time'),
+        'event': Index('event'),
+        'status': Index('status'),
+        'environment': Index('environment'),
+        'service': Index('service'),
+        'event_time': Index('event', 'time'),
+        'status_time': Index('status', 'time'),
+        'environment_time': Index('environment', 'time'),
+        'service_time': Index('service', 'time'),
+    },
+    'services': {
+        'image-name': Index('image-name'),
+        'environments': Index('environments', multi=True),
+    },
+    'delayed_tasks': {
+        'at': Index('at'),
+        'event': Index('event'),
+        'environment': Index('parameters.environment'),
+        'service': Index('parameters.service'),
+        'service_at': Index('parameters.service', 'at'),
+    },
+    'webhooks': {
+        'event': Index('event'),
+    },
+}
+
+ready = {}
+building = {}
+
+
+def index_name(*fields):
+    """
+    :param fields: the fields of an index
+    :return: the name of the index on those fields
+    """
+    return '_'.join(fields)
+
+
+def declared(table_name, *fields):
+    """
+    :param table_name: name of the table
+    :param fields: the fields of the index, in order
+    :return: the name of the declared index on the fields, or None
+    """
+    name = index_name(*fields)
+    index = INDEXES.get(table_name, {}).get(name)
+    if index is not None and index.fields == list(fields) \
+            and not index.multi:
+        return name
+    return None
+
+
+async def ready_names(table_name):
+    """
+    Returns the names of the ready indexes of a table, declared or not,
+    and its primary key, which can be read like an index. The names are
+    fetched from the database at most every ``REFRESH_INTERVAL`` seconds.
+    If they cannot be fetched, the declared indexes are assumed to be
+    ready, and the names are fetched again next time.
+
+    :param table_name: name of the table
+    :return: set of index names
+    """
+    fetched, names = ready.get(table_name, (0, None))
+    if names is not None and time.time() - fetched < REFRESH_INTERVAL:
+        return names
+
+    table = rdb_conn.conn.db().table(table_name)
+    try:
+        result = await rdb_conn.conn.run(r.expr({
+            'indexes': table.index_status().filter({'ready': True})['index']
+                .coerce_to('array'),
+            'primary_key': table.info()['primary_key']
+        }))
+    except r.errors.ReqlError as e:
+        logger.warn(f'Could not list indexes of {table_name}: {e}')
+        return set(INDEXES.get(table_name, ()))
+
+    names = set(result['indexes']) | {result['primary_key']}
+    ready[table_name] = time.time(), names
+    return names
+
+
+async def available(table_name):
+    """
+    Returns the indexes of a table that are declared and ready to be
+    queried.
+
+    :param table_name: name of the table
+    :return: set of index names
+    """
+    if table_name not in INDEXES:
+        return set()
+    return await ready_names(table_name) & set(INDEXES[table_name])
+
+
+async def is_ready(table_name, name):
+    """
+    :param table_name: name of the table
+    :param name: name of an index, declared or not
+    :return: True if the table has the index and it is ready
+    """
+    return name in await ready_names(table_name)
+
+
+async def find(table_name, *fields):
+    """
+    :param table_name: name of the table
+    :param fields: the fields of the index, in order
+    :return: the name of a ready index on the fields, or None
+    """
+    name = declared(table_name, *fields)
+    if name is not None and name in await available(table_name):
+        return name
+    return None
+
+
+# -- migration
+
+def init():
+    """
+    Starts creating the declared indexes that do not exist yet, in the
+    background.
+    """
+    asyncio.ensure_future(migrate())
+
+
+async def migrate():
+    """
+    Creates the indexes in :data:`INDEXES` that the database does not have.
+    The indexes are built by the database in the background; until one is
+    ready the query planner does not use it, and its build progress is
+    kept in :data:`building`.
+    """
+    for table_name, declared_indexes in INDEXES.items():
+        table = rdb_conn.conn.db().table(table_name)
+        try:
+            existing = set(await rdb_conn.conn.run(table.index_list()))
+        except r.errors.ReqlError as e:
+            logger.warn(f'Could not list indexes of {table_name}: {e}')
+            continue
+
+        created = []
+        for name, index in declared_indexes.items():
+            if name in existing:
+                continue
+            try:
+                await rdb_conn.conn.run(index.create(table, name))
+            except r.errors.ReqlOpFailedError as e:
+                # Another replica may have created it first.
+                logger.warn(f'Could not create index {name} on '
+                            f'{table_name}: {e}')
+                continue
+            logger.info(f'Creating index {name} on {table_name}')
+            created.append(name)
+
+        if created:
+            building[table_name] = dict.fromkeys(created, 0)
+            asyncio.ensure_future(wait(table_name, created))
+
+
+async def wait(table_name, names):
+    """
+    Waits for indexes to be built, reporting their progress meanwhile.
+
+    :param table_name: name of the table
+    :param names: names of the indexes
+    """
+    table = rdb_conn.conn.db().table(table_name)
+    reporter = asyncio.ensure_future(report(table_name, names))
+    try:
+        await rdb_conn.conn.run(table.index_wait(*names))
+    except r.errors.ReqlError as e:
+        logger.warn(f'Waiting for indexes {", ".join(names)} on '
+                    f'{table_name} failed: {e}')
+        return
+    finally:
+        reporter.cancel()
+
+    building.pop(table_name, None)
+    ready.pop(table_name, None)
+    logger.info(f'Indexes {", ".join(names)} on {table_name} are ready')
+
+
+async def report(table_name, names):
+    """
+    Logs, and keeps in :data:`building`, the build progress of indexes
+    every ``PROGRESS_INTERVAL`` seconds.
+
+    :param table_name: name of the table
+    :param names: names of the indexes
+    """
+    table = rdb_conn.conn.db().table(table_name)
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        try:
+            statuses = await rdb_conn.conn.run(table.index_status(*names))
+        except r.errors.ReqlError as e:
+            logger.warn(f'Could not get index status of {table_name}: {e}')
+            continue
+
+        progress = {status['index']: 1 if status['ready']
+                    else status.get('progress', 0)
+                    for status in statuses}
+        building[table_name] = progress
+        logger.info(f'Building indexes on {table_name}: ' + ', '.join(
+            f'{name} {value:.0%}' for name, value in progress.items()))
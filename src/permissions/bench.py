@@ -0,0 +1,66 @@
+"""
+Microbenchmark of compiled permission checks against the tree-walking
+checks of :mod:`permissions.permission`.
+
+Run from the src directory with ``python -m permissions.bench``.
+"""
+import asyncio
+import sys
+import time
+
+from permissions import compiled, permission
+
+ENVIRONMENTS = [f'env{i}' for i in range(20)]
+
+TREE = {
+    'cion': {
+        'user': ['create', 'edit'],
+        'view': ['events', 'config'],
+        'config': ['edit']
+    }
+}
+for env in ENVIRONMENTS:
+    TREE[env] = {'service': ['create', 'delete', 'deploy']}
+
+
+async def resolve_env(request):
+    return {'env': request['env']}
+
+
+def expressions(module):
+    return {
+        'simple': module.perm('cion.view.events'),
+        'and/or': (module.perm('cion.user.create')
+                   & module.perm('cion.user.edit'))
+                  | module.perm('cion.user.delete'),
+        'placeholder': module.perm('$env.service.deploy', resolve_env),
+    }
+
+
+async def run(expr, permissions, request, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await expr.has_permission(permissions, lambda reason: None, request)
+    return time.perf_counter() - start
+
+
+async def main(iterations):
+    request = {'env': ENVIRONMENTS}
+    flat = compiled.flatten(TREE)
+    tree_exprs = expressions(permission)
+    compiled_exprs = expressions(compiled)
+
+    print(f'{"expression":<14}{"tree":>12}{"compiled":>12}{"speedup":>10}')
+    for name in tree_exprs:
+        tree_time = await run(tree_exprs[name], TREE, request, iterations)
+        compiled_time = await run(compiled_exprs[name], flat, request,
+                                  iterations)
+        print(f'{name:<14}'
+              f'{tree_time / iterations * 1e6:>10.2f}us'
+              f'{compiled_time / iterations * 1e6:>10.2f}us'
+              f'{tree_time / compiled_time:>9.1f}x')
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    asyncio.get_event_loop().run_until_complete(main(count))
@@ -0,0 +1,167 @@
+import asyncio
+import itertools
+
+import request_context
+from permissions.permission import Permission
+
+
+def flatten(permission_tree):
+    """
+    Flattens a permission tree into the set of dotted paths it grants.
+
+    The tree ``{'cion': {'user': ['edit', 'create']}}`` becomes
+    ``{'cion.user.edit', 'cion.user.create'}``.
+
+    :param permission_tree: A dictionary tree with lists as leaves
+    :return: frozenset of period-separated paths
+    """
+    paths = set()
+
+    def walk(node, prefix):
+        if isinstance(node, dict):
+            for key, child in node.items():
+                walk(child, prefix + (str(key),))
+        elif isinstance(node, list):
+            for key in node:
+                paths.add('.'.join(prefix + (str(key),)))
+
+    walk(permission_tree or {}, ())
+    return frozenset(paths)
+
+
+def permission_set(session):
+    """
+    Returns the flattened permissions of a session, flattening them if the
+    session does not have them yet.
+
+    :param session: session object
+    :return: frozenset of period-separated paths
+    """
+    perms = session.get('permission-set')
+    if perms is None:
+        perms = session['permission-set'] = \
+            flatten(session['user'].get('permissions'))
+    return perms
+
+
+def expand(path_list, placeholder_vals):
+    """
+    Expands the placeholders of a path. A placeholder resolved to a list
+    expands to one path per value.
+
+    :param path_list: the keys of a path
+    :param placeholder_vals: dictionary of placeholder values
+    :return: iterator of period-separated paths
+    """
+    options = []
+    for key in path_list:
+        if key[0] == '$':
+            resolved = placeholder_vals[key[1:]]
+            options.append(resolved if isinstance(resolved, list)
+                           else [resolved])
+        else:
+            options.append([key])
+
+    return ('.'.join(keys) for keys in itertools.product(*options))
+
+
+class CompiledPermission(Permission):
+    """
+    A permission expression checked against a flattened permission set,
+    see :func:`flatten`, instead of walking the permission tree.
+
+    ``evaluate`` is a function taking the permission set, a dictionary of
+    placeholder values by resolver and a list to append missing paths to.
+    ``resolvers`` are the placeholder resolvers the expression needs; they
+    are awaited concurrently, at most once per request, see
+    :func:`request_context.resolve`.
+    """
+    compiled = True
+
+    def __init__(self, evaluate, resolvers=()):
+        self.evaluate = evaluate
+        self.resolvers = tuple(resolvers)
+        super().__init__(self.check)
+
+    async def resolve(self, request):
+        """
+        :param request: aiohttp request object
+        :return: placeholder values by resolver
+        """
+        if len(self.resolvers) == 1:
+            resolver, = self.resolvers
+            return {resolver: await request_context.resolve(request,
+                                                            resolver)}
+
+        results = await asyncio.gather(
+            *(request_context.resolve(request, resolver)
+              for resolver in self.resolvers))
+        return dict(zip(self.resolvers, results))
+
+    async def check(self, permission_set, error_reason, request):
+        values = await self.resolve(request) if self.resolvers else None
+        missing = []
+        if self.evaluate(permission_set, values, missing):
+            return True
+        for path in missing:
+            error_reason(path)
+        return False
+
+    def __and__(self, other):
+        if not isinstance(other, CompiledPermission):
+            return NotImplemented
+
+        def evaluate(perms, values, missing):
+            return self.evaluate(perms, values, missing) \
+                   and other.evaluate(perms, values, missing)
+
+        return CompiledPermission(evaluate, self._merge(other))
+
+    def __or__(self, other):
+        if not isinstance(other, CompiledPermission):
+            return NotImplemented
+
+        def evaluate(perms, values, missing):
+            return self.evaluate(perms, values, missing) \
+                   or other.evaluate(perms, values, missing)
+
+        return CompiledPermission(evaluate, self._merge(other))
+
+    def _merge(self, other):
+        return self.resolvers + tuple(resolver for resolver in other.resolvers
+                                      if resolver not in self.resolvers)
+
+
+def perm(path, resolve_placeholders=None):
+    """
+    Like :func:`permissions.permission.perm`, but compiles the path into a
+    set-membership check against a flattened permission set.
+
+    Placeholders, keys beginning with the character *$*, are expanded with
+    the values returned by ``resolve_placeholders``. A placeholder resolved
+    to a list requires the path for every value in it; every missing one
+    is reported, not just the first.
+
+    :param path: A period-separated string representing a path
+    :param resolve_placeholders: A function resolve placeholders
+    :return: The compiled permission object
+    """
+    path_l = path.split('.')
+
+    if not any(key[0] == '$' for key in path_l):
+        def evaluate(perms, values, missing):
+            if path in perms:
+                return True
+            missing.append(path)
+            return False
+
+        return CompiledPermission(evaluate)
+
+    def evaluate(perms, values, missing):
+        denied = [expanded for expanded
+                  in expand(path_l, values[resolve_placeholders])
+                  if expanded not in perms]
+        missing.extend(denied)
+        return not denied
+
+    return CompiledPermission(evaluate, (resolve_placeholders,))
@@ -1,3 +1,6 @@
+import request_context
+
+
 class Permission:
     """
     Represents on permission path
@@ -48,6 +51,43 @@ class Permission:
         return Permission(check)
 
 
+def walk(node, path_list, prefix, placeholder_vals, error_reason):
+    """
+    Checks that a permission tree contains a path. A placeholder resolved
+    to a list requires the rest of the path under every value; every value
+    is checked, so every missing path is reported, like the compiled
+    engine in :mod:`permissions.compiled` does.
+
+    :param node: the permission tree, or the part of it to check in
+    :param path_list: the keys of the path left to check
+    :param prefix: the keys already walked, for error reporting
+    :param placeholder_vals: dictionary of placeholder values
+    :param error_reason: function called with every missing path
+    :return: True if the path is in the tree
+    """
+    for i, key in enumerate(path_list[:-1]):
+        if key[0] == "$":
+            resolved = placeholder_vals[key[1:]]
+            if isinstance(resolved, list):
+                results = [walk(node, [value] + path_list[i + 1:], prefix,
+                                placeholder_vals, error_reason)
+                           for value in resolved]
+                return all(results)
+            key = resolved
+
+        if key in node:
+            node = node[key]
+            prefix = prefix + [key]
+        else:
+            error_reason('.'.join(prefix + [key] + path_list[i + 1:]))
+            return False
+
+    if isinstance(node, list) and path_list[-1] in node:
+        return True
+    error_reason('.'.join(prefix + path_list[-1:]))
+    return False
+
+
 def perm(path, resolve_placeholders=None):
     """
     Creates and returns a permission object.
@@ -56,7 +96,8 @@ def perm(path, resolve_placeholders=None):
 
     ``resolve_placeholders`` has ot be a function that takes an aiohttp request
     as a parameter and returns a dictionary containing the values for the
-    placeholders defined in the path.
+    placeholders defined in the path. It is called at most once per
+    request, see :func:`request_context.resolve`.
 
     So the permission-path *$env.user* would need a ``resolve_placeholders``
     function that returns a dictionary with the key *env* having a value.
@@ -67,34 +108,11 @@ def perm(path, resolve_placeholders=None):
     """
     path_l = path.split('.')
 
-    async def check(permission_tree, error_reason, request, path_list=path_l):
-        if resolve_placeholders:
-            placeholder_vals = await resolve_placeholders(request)
-
-        node = permission_tree
-
-        for i, key in enumerate(path_list[:-1]):
-            if key[0] == "$":
-                resolved = placeholder_vals[key[1:]]
-                if isinstance(resolved, list):
-                    def recur(key_resolved):
-                        return check(
-                            node[key_resolved],
-                            error_reason,
-                            request,
-                            path_list=path_list[i + 1:])
-
-                    return all(
-                        [key in node and await recur(key) for key in resolved])
-                else:
-                    key = resolved
-
-            if key in node:
-                node = node[key]
-            else:
-                error_reason(path)
-                return False
-
-        return isinstance(node, list) and (path_list[-1] in node)
+    async def check(permission_tree, error_reason, request):
+        placeholder_vals = \
+            await request_context.resolve(request, resolve_placeholders) \
+            if resolve_placeholders else {}
+        return walk(permission_tree, path_l, [], placeholder_vals,
+                          error_reason)
 
     return Permission(check)
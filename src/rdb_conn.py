@@ -115,11 +115,13 @@ async def _init_database():
     logger.info('Initializing database')
 
     await ensure_db_exists('cion')
-    await ensure_table_exists('tasks', indices=['time'])
+    await ensure_table_exists('tasks')
     await ensure_table_exists('users', primary_key='username',
                               func=r.db('cion').table('users').insert(
                                   create_admin_user_insert())
                               )
+    await ensure_table_exists('sessions', indices=['username'])
+    await ensure_table_exists('api_tokens')
 
     with open('default_docs.json') as file:
         for table in json.load(file):
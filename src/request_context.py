@@ -0,0 +1,86 @@
+import asyncio
+
+KEY = 'request-context'
+
+
+class RequestContext:
+    """
+    Values computed for one request and shared by everything handling it,
+    the permission resolvers and the endpoint alike: the parsed body and
+    the results of memoized calls, like placeholder resolvers and database
+    lookups.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.memo = {}
+
+    def memoize(self, key, func, *args):
+        """
+        Calls ``func(*args)`` the first time a key is asked for and returns
+        the same awaitable result for it for the rest of the request.
+        Concurrent callers share the pending call.
+
+        :param key: hashable key of the value
+        :param func: coroutine function computing the value
+        :param args: arguments for ``func``
+        :return: awaitable resolving to the value
+        """
+        future = self.memo.get(key)
+        if future is None:
+            future = self.memo[key] = asyncio.ensure_future(func(*args))
+        return future
+
+    def json(self):
+        """
+        :return: awaitable resolving to the request body, parsed once
+        """
+        return self.memoize(KEY, self.request.json)
+
+
+def get(request):
+    """
+    Returns the context of a request, creating it the first time.
+
+    :param request: aiohttp request object
+    :return: the :class:`RequestContext` of the request
+    """
+    context = request.get(KEY)
+    if context is None:
+        context = request[KEY] = RequestContext(request)
+    return context
+
+
+async def body(request):
+    """
+    Parses the json body of a request, at most once per request.
+
+    :param request: aiohttp request object
+    :return: the parsed body
+    """
+    return await get(request).json()
+
+
+async def memoize(request, key, func, *args):
+    """
+    Memoizes ``func(*args)`` for the life of a request, see
+    :meth:`RequestContext.memoize`.
+
+    :param request: aiohttp request object
+    :param key: hashable key of the value
+    :param func: coroutine function computing the value
+    :param args: arguments for ``func``
+    :return: the value
+    """
+    return await get(request).memoize(key, func, *args)
+
+
+async def resolve(request, resolver):
+    """
+    Runs a permission placeholder resolver at most once per request.
+
+    :param request: aiohttp request object
+    :param resolver: placeholder resolver function
+    :return: the resolved placeholder values
+    """
+    return await memoize(request, resolver, resolver, request)
@@ -1,74 +1,283 @@
+import os
 import re
+from collections import OrderedDict
 
 import rethinkdb as r
-from luqum.parser import parser
-from luqum.tree import FieldGroup, Term, AndOperation, OrOperation, SearchField
+from luqum.parser import parser, ParseError
+from luqum.tree import FieldGroup, Group, Term, AndOperation, OrOperation, \
+    SearchField, Range
 import datetime
+import time
 from logzero import logger
 
+import indexes
+
+# Fields holding names, like event names and statuses. Terms on them match
+# the whole value, so they can be answered by an index; other fields are
+# matched with a regular expression.
+KEYWORD_FIELDS = ('event', 'status', 'environment', 'service')
+
+# Fields holding times, in seconds since the epoch. Terms on them select a
+# range of times, see :func:`time_range`.
+TIME_FIELDS = ('time',)
+
+WILDCARDS = re.compile(r'[*?]')
+
+RELATIVE_TIME = re.compile(r'^now(?:([+-])(\d+(?:\.\d+)?)([smhdw]))?$')
+TIME_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60,
+              'w': 7 * 24 * 60 * 60}
+DATE_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%dT%H:%M', '%Y-%m-%d')
+
+CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', '256'))
+
+trees = OrderedDict()
+plans = OrderedDict()
+
+
+def normalize(search_string):
+    """
+    :param search_string: lucene search string
+    :return: the search string with runs of whitespace collapsed
+    """
+    return ' '.join(search_string.split())
+
+
+def cached(cache, key, value=None):
+    """
+    Looks up, or stores, a value in an LRU cache of ``CACHE_SIZE`` entries.
+
+    :param cache: the OrderedDict to use
+    :param key: key of the value
+    :param value: value to store, or None to look up
+    :return: the cached value, or None
+    """
+    if value is None:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+    cache[key] = value
+    while len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+    return value
+
+
+def parse(search_string):
+    """
+    Parses a search string, at most once per normalized search string while
+    it is in the cache.
+
+    :param search_string: lucene search string
+    :raises ParseError: if the search string is malformed
+    :return: the luqum tree
+    """
+    key = normalize(search_string)
+    tree = cached(trees, key)
+    if tree is None:
+        tree = cached(trees, key, parser.parse(key))
+    return tree
+
+
+def term_value(term):
+    return term.value.strip('"\'')
+
+
+def is_literal(term):
+    """
+    :param term: luqum term
+    :return: True if the term is a plain value without wildcards
+    """
+    return isinstance(term, Term) and not WILDCARDS.search(term_value(term))
+
+
+def wildcard_regex(value):
+    """
+    Translates a lucene wildcard value, with *\** and *?*, to an anchored
+    regular expression.
+    """
+    return '^' + ''.join('.*' if char == '*' else
+                         '.' if char == '?' else
+                         re.escape(char) for char in value) + '$'
+
+
+def match(value, expr, name=None):
+    if name in TIME_FIELDS:
+        return time_range(name, expr).filter(value)
 
-def match(value, expr):
     to_compare = expr.value.strip('"\'')
-    # if to_compare[0] == ">":
-    #     return r.epoch_time(value) > parse_date_time(to_compare[1:])
-    # elif to_compare[0] == "<":
-    #     return r.epoch_time(value) < parse_date_time(to_compare[1:])
-    # elif to_compare.find('-') > -1:
-    #     time_from, time_to = to_compare.split(' - ')
-    #     return r.epoch_time(value).during(parse_date_time(time_from),
-    #                                       parse_date_time(time_to))
-    print(to_compare, value)
+    if name in KEYWORD_FIELDS:
+        if is_literal(expr):
+            return value.eq(to_compare)
+        return value.match(wildcard_regex(to_compare))
     return value.match(to_compare)
 
 
-def parse_date_time(val):  # FIXME: this is a badly implemented bloated feature
-    s = val.split('-')
-    year = 1970
-    month = r.january
-    day = 0
-    time = 0
-
-    l = len(s)
-    if l > 0:
-        time = s[0]
-    if l > 1:
-        day = int(s[1])
-    if l > 2:
-        month = int(s[2])
-    if l > 3:
-        year = int(s[3])
-
-    now = datetime.datetime.now()  # TODO: get timezone from browser
-    if not year:
-        year = now.year
-    if not month:
-        month = now.month
-    if not day:
-        day = now.day
-    t = time.split('.')
-    hour = int(t[0])
-    minute = 0
-    second = 0
-
-    l = len(t)
-    if l > 1:
-        minute = int(t[1])
-    if l > 2:
-        second = int(t[2])
-    return r.time(year, month, day, hour, minute, second, "Z")
+def parse_time(value, now):
+    """
+    Parses a time in a search: *now*, optionally with an offset like
+    *now-1h* or *now+30m* (units s, m, h, d and w), an ISO 8601 date or
+    date and time, taken to be UTC, or seconds since the epoch.
+
+    :param value: the time
+    :param now: the current time, in seconds since the epoch
+    :raises ParseError: if the time is malformed
+    :return: seconds since the epoch, or None for *\**
+    """
+    value = value.strip('"\'')
+    if value == '*':
+        return None
+
+    relative = RELATIVE_TIME.match(value)
+    if relative:
+        sign, amount, unit = relative.groups()
+        if not sign:
+            return now
+        offset = float(amount) * TIME_UNITS[unit]
+        return now - offset if sign == '-' else now + offset
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    if value.endswith('Z'):
+        value = value[:-1]
+    for fmt in DATE_FORMATS:
+        try:
+            parsed = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return parsed.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    raise ParseError(f'Bad time {value!r}')
+
+
+def is_date(value):
+    try:
+        datetime.datetime.strptime(value.strip('"\''), '%Y-%m-%d')
+    except ValueError:
+        return False
+    return True
+
+
+class TimeRange:
+    """
+    A range of times on a field, like *time:[2026-10-01 TO now]*. Relative
+    times, like *now-1h*, are resolved each time :meth:`bounds` is called,
+    so a range can be reused. An inclusive upper bound that is a date
+    includes the whole day.
+    """
+
+    def __init__(self, field, low, high, include_low=True,
+                 include_high=True):
+        self.field = field
+        self.low = low
+        self.high = high
+        self.include_low = include_low
+        self.whole_day = include_high and high is not None and is_date(high)
+        self.include_high = include_high and not self.whole_day
+
+    def bounds(self):
+        """
+        :raises ParseError: if a time is malformed
+        :return: the low and high bound in seconds since the epoch; None
+            for an open end
+        """
+        now = time.time()
+        low = None if self.low is None else parse_time(self.low, now)
+        high = None if self.high is None else parse_time(self.high, now)
+        if self.whole_day:
+            high += TIME_UNITS['d']
+        return low, high
+
+    def filter(self, value):
+        """
+        :param value: rethinkdb value of the field
+        :return: rethinkdb expression checking the value is in the range
+        """
+        low, high = self.bounds()
+        checks = []
+        if low is not None:
+            checks.append(value >= low if self.include_low else value > low)
+        if high is not None:
+            checks.append(value <= high if self.include_high
+                          else value < high)
+        return r.and_(*checks) if checks else r.expr(True)
+
+    def explain(self):
+        low, high = self.bounds()
+        return {'field': self.field, 'low': low, 'high': high,
+                'include-low': self.include_low,
+                'include-high': self.include_high}
+
+
+def time_range(name, expr):
+    """
+    Reads the range of times a search term on a time field selects:
+    *[a TO b]* and *{a TO b}* ranges, *>a*, *>=a*, *<b* and *<=b*, a date,
+    which selects the whole day, or a single time.
+
+    :param name: name of the time field
+    :param expr: luqum term or range
+    :raises ParseError: if the term is not a time range
+    :return: the :class:`TimeRange`
+    """
+    if isinstance(expr, Range):
+        return TimeRange(name, term_value(expr.low), term_value(expr.high),
+                         expr.include_low, expr.include_high)
+    if not isinstance(expr, Term):
+        raise ParseError(f'Bad time range {expr}')
+
+    value = term_value(expr)
+    for operator in ('>=', '<=', '>', '<'):
+        if value.startswith(operator):
+            bound = value[len(operator):]
+            if operator[0] == '>':
+                return TimeRange(name, bound, None,
+                                 include_low=operator == '>=')
+            return TimeRange(name, None, bound,
+                             include_high=operator == '<=')
+
+    return TimeRange(name, value, value)
+
+
+def relative_times(node, name=None):
+    """
+    Finds the relative times, like *now-1h*, in a search tree.
+
+    :param node: luqum tree
+    :param name: name of the field the tree is scoped to
+    :raises ParseError: if a time range is malformed
+    :return: list of the relative times
+    """
+    if isinstance(node, SearchField):
+        name = node.name
+    elif name in TIME_FIELDS and isinstance(node, (Term, Range)):
+        span = time_range(name, node)
+        return [bound for bound in (span.low, span.high)
+                if bound is not None and RELATIVE_TIME.match(
+                    bound.strip('"\''))]
+    return [found for child in node.children
+            for found in relative_times(child, name)]
 
 
 def traverse(row, group, name):
     if isinstance(group, Term):
-        return match(row[name], group)
+        return match(row[name], group, name)
+    elif isinstance(group, Range):
+        return time_range(name, group).filter(row[name])
     elif isinstance(group, SearchField):
         return traverse(row, group.expr, group.name)
-    elif isinstance(group, FieldGroup):
+    elif isinstance(group, (FieldGroup, Group)):
         return traverse(row, group.children[0], name)
     elif isinstance(group, AndOperation):
-        return all(traverse(row, operand, name) for operand in group.children)
+        return r.and_(*(traverse(row, operand, name)
+                        for operand in group.children))
     elif isinstance(group, OrOperation):
-        return any(traverse(row, operand, name) for operand in group.children)
+        return r.or_(*(traverse(row, operand, name)
+                       for operand in group.children))
 
 
 def get_filter(search_string):
@@ -76,10 +285,7 @@ def get_filter(search_string):
         logger.debug('Search string empty. Skipping filtering')
         return None
 
-    tree = parser.parse(search_string)
-
-    print(tree.__dict__)
-    print(dir(tree))
+    tree = parse(search_string)
 
     def filter_func(row):
         return traverse(row, tree, None)
@@ -87,6 +293,360 @@ def get_filter(search_string):
     return filter_func
 
 
+def unwrap(node):
+    while isinstance(node, (FieldGroup, Group)):
+        node = node.children[0]
+    return node
+
+
+def conjuncts(tree):
+    """
+    Splits a search tree on its top level AND operations.
+
+    :param tree: luqum tree
+    :return: list of trees that must all match
+    """
+    node = unwrap(tree)
+    if isinstance(node, AndOperation):
+        return [part for child in node.children for part in conjuncts(child)]
+    return [node]
+
+
+def equality(node, name=None):
+    """
+    Recognizes a search tree that requires a keyword field to equal one of
+    a set of values, like *event:new-image* or *status:(done OR ready)*.
+
+    :param node: luqum tree
+    :param name: name of the field the tree is scoped to
+    :return: the field and the list of values, or None
+    """
+    node = unwrap(node)
+    if isinstance(node, SearchField):
+        return equality(node.expr, node.name)
+    if isinstance(node, Term):
+        if name in KEYWORD_FIELDS and is_literal(node):
+            return name, [term_value(node)]
+        return None
+    if isinstance(node, OrOperation):
+        parts = [equality(child, name) for child in node.children]
+        if all(parts) and len({field for field, _ in parts}) == 1:
+            return parts[0][0], [value for _, values in parts
+                                 for value in values]
+    return None
+
+
+def filter_of(parts):
+    """
+    :param parts: list of luqum trees that must all match
+    :return: a rethinkdb filter function, or None if there are no parts
+    """
+    if not parts:
+        return None
+
+    def filter_func(row):
+        return r.and_(*(traverse(row, part, None) for part in parts))
+
+    return filter_func
+
+
+def time_part(node):
+    """
+    Recognizes a search tree that selects a range of times, like
+    *time:>now-1h*.
+
+    :param node: luqum tree
+    :raises ParseError: if a time is malformed
+    :return: the :class:`TimeRange`, or None
+    """
+    node = unwrap(node)
+    if not isinstance(node, SearchField) or node.name not in TIME_FIELDS:
+        return None
+    expr = unwrap(node.expr)
+    if not isinstance(expr, (Term, Range)):
+        return None
+    span = time_range(node.name, expr)
+    span.bounds()
+    return span
+
+
+class Plan:
+    """
+    How to run a search on a table sorted by an index.
+
+    If one of the AND-ed parts of the search is an equality on a keyword
+    field with a compound index on the field and the sort field, the
+    ordered query reads only the matching range of that index with
+    ``between``; one range per value, merged in sort order. Otherwise it
+    reads the sort index. A time range on the sort field narrows the
+    range read, so it costs nothing to filter. Unordered queries, like
+    counts, use ``get_all`` on a simple index on the field when there is
+    one, or ``between`` on an index on the time field. The parts the
+    indexes do not answer are applied with ``filter``.
+    """
+
+    def __init__(self, sort_index, sort_direction, parts=(), key=None,
+                 field=None, values=(), compound=None, simple=None,
+                 span_part=None, span=None, span_index=None):
+        self.sort_index = sort_index
+        self.sort_direction = sort_direction
+        self.parts = list(parts)
+        self.key = key
+        self.field = field
+        self.values = list(values)
+        self.compound = compound
+        self.simple = simple
+        self.span_part = span_part
+        self.span = span
+        self.span_index = span_index
+
+    @property
+    def filter_func(self):
+        """
+        The filter matching the whole search, or None for no search.
+        """
+        return filter_of(self.parts)
+
+    @property
+    def sorted_span(self):
+        """
+        The time range, if it is on the sort field.
+        """
+        if self.span is not None and self.span.field == self.sort_index:
+            return self.span
+        return None
+
+    def residual(self, *answered):
+        return [part for part in self.parts
+                if not any(part is other for other in answered)]
+
+    def ordered_residual(self):
+        return self.residual(self.compound and self.key,
+                             self.sorted_span and self.span_part)
+
+    def count_access(self):
+        """
+        :return: the index unordered queries read, and the time range they
+            read of it, if any
+        """
+        if self.compound and (self.sorted_span or not self.simple):
+            return self.compound, self.sorted_span
+        if self.simple:
+            return self.simple, None
+        if self.span is not None and self.span_index:
+            return self.span_index, self.span
+        return None, None
+
+    def count_residual(self):
+        index, span = self.count_access()
+        return self.residual(index and index != self.span_index and self.key,
+                             span and self.span_part)
+
+    def sort_bounds(self, after=None):
+        """
+        :param after: sort value, primary key name and primary key value of
+            the row to continue after, or None
+        :return: lower and upper bound of the sort field to read, and
+            whether each is closed
+        """
+        lower, upper = r.minval, r.maxval
+        left, right = 'closed', 'closed'
+
+        span = self.sorted_span
+        if span is not None:
+            low, high = span.bounds()
+            if low is not None:
+                lower = low
+                left = 'closed' if span.include_low else 'open'
+            if high is not None:
+                upper = high
+                right = 'closed' if span.include_high else 'open'
+
+        if after:
+            value = after[0]
+            if self.sort_direction is r.desc:
+                if upper is r.maxval or below(value, upper):
+                    upper, right = value, 'closed'
+            elif lower is r.minval or below(lower, value):
+                lower, left = value, 'closed'
+
+        return lower, upper, left, right
+
+    def ordered(self, table, after=None):
+        """
+        Builds the query for the search, ordered by the sort index.
+
+        :param table: rethinkdb table
+        :param after: sort value, primary key name and primary key value of
+            the row to continue after, or None to start from the beginning
+        :return: the rethinkdb query
+        """
+        lower, upper, left, right = self.sort_bounds(after)
+
+        if self.compound:
+            streams = [
+                table.between([value, lower], [value, upper],
+                              index=self.compound, left_bound=left,
+                              right_bound=right)
+                    .order_by(index=self.sort_direction(self.compound))
+                for value in self.values]
+
+            query = streams[0]
+            if len(streams) > 1:
+                query = query.union(
+                    *streams[1:],
+                    interleave=self.sort_direction(self.sort_index))
+        else:
+            if lower is not r.minval or upper is not r.maxval:
+                table = table.between(lower, upper, index=self.sort_index,
+                                      left_bound=left, right_bound=right)
+            query = table.order_by(index=self.sort_direction(self.sort_index))
+
+        if after:
+            sort_value, primary_key, key_value = after
+            if self.sort_direction is r.desc:
+                def after_filter(row):
+                    return (row[self.sort_index] < sort_value) \
+                           | (row[primary_key] < key_value)
+            else:
+                def after_filter(row):
+                    return (row[self.sort_index] > sort_value) \
+                           | (row[primary_key] > key_value)
+            query = query.filter(after_filter)
+
+        residual = filter_of(self.ordered_residual())
+        return query.filter(residual) if residual else query
+
+    def unordered(self, table):
+        """
+        Builds the query for the search, in no particular order.
+
+        :param table: rethinkdb table
+        :return: the rethinkdb query
+        """
+        index, span = self.count_access()
+        lower, upper = r.minval, r.maxval
+        bounds = {}
+        if span is not None:
+            low, high = span.bounds()
+            lower = r.minval if low is None else low
+            upper = r.maxval if high is None else high
+            bounds = {'left_bound': 'closed' if span.include_low else 'open',
+                      'right_bound': 'closed' if span.include_high
+                      else 'open'}
+
+        if index is None:
+            query = table
+        elif index == self.simple:
+            query = table.get_all(*self.values, index=index)
+        elif index == self.compound:
+            streams = [table.between([value, lower], [value, upper],
+                                     index=index, **bounds)
+                       for value in self.values]
+            query = streams[0].union(*streams[1:]) if len(streams) > 1 \
+                else streams[0]
+        else:
+            query = table.between(lower, upper, index=index, **bounds)
+
+        residual = filter_of(self.count_residual())
+        return query.filter(residual) if residual else query
+
+    def explain(self):
+        """
+        :return: a json serializable description of the plan
+        """
+        count_index, _ = self.count_access()
+        return {
+            'strategy': 'between' if self.compound or self.sorted_span
+                        else 'scan',
+            'index': self.compound or self.sort_index,
+            'field': self.field,
+            'values': self.values,
+            'range': self.span.explain() if self.span else None,
+            'count-strategy': 'scan' if count_index is None else
+                              'get_all' if count_index == self.simple
+                              else 'between',
+            'count-index': count_index,
+            'filter': [str(part) for part in self.ordered_residual()],
+            'count-filter': [str(part) for part in self.count_residual()],
+        }
+
+
+def below(value, other):
+    """
+    :return: True if ``value`` is below ``other``, or if they cannot be
+        compared
+    """
+    try:
+        return value < other
+    except TypeError:
+        return True
+
+
+async def plan(search_string, table_name, sort_index, sort_direction):
+    """
+    Plans a search on a table, using the indexes declared in
+    :mod:`indexes` that are ready. Plans are cached by normalized search
+    string and the indexes they could use; relative times in a cached plan
+    are still resolved each time it is used.
+
+    :param search_string: lucene search string
+    :param table_name: name of the table
+    :param sort_index: name of the index to sort by
+    :param sort_direction: ``r.asc`` or ``r.desc``
+    :raises luqum.parser.ParseError: if the search string is malformed
+    :return: the :class:`Plan`
+    """
+    if not search_string.strip():
+        return Plan(sort_index, sort_direction)
+
+    key = (normalize(search_string), table_name, sort_index,
+           sort_direction is r.desc, frozenset(await indexes.available(
+               table_name)))
+    result = cached(plans, key)
+    if result is None:
+        result = cached(plans, key, await build_plan(
+            search_string, table_name, sort_index, sort_direction))
+    return result
+
+
+async def build_plan(search_string, table_name, sort_index, sort_direction):
+    parts = conjuncts(parse(search_string))
+
+    span_part = span = span_index = None
+    for part in parts:
+        found = time_part(part)
+        if found is not None:
+            span_part, span = part, found
+            span_index = await indexes.find(table_name, span.field)
+            if span.field == sort_index:
+                break
+
+    candidates = []
+    for part in parts:
+        found = equality(part)
+        if found is None:
+            continue
+        field, values = found
+        compound = await indexes.find(table_name, field, sort_index)
+        simple = await indexes.find(table_name, field)
+        if compound or simple:
+            candidates.append((part, field, values, compound, simple))
+
+    if not candidates:
+        result = Plan(sort_index, sort_direction, parts, span_part=span_part,
+                      span=span, span_index=span_index)
+    else:
+        key, field, values, compound, simple = min(
+            candidates, key=lambda c: (c[3] is None, len(c[2])))
+        result = Plan(sort_index, sort_direction, parts, key, field, values,
+                      compound, simple, span_part, span, span_index)
+
+    logger.debug(f'Search plan for {search_string!r} on {table_name}: '
+                 f'{result.explain()}')
+    return result
+
+
 if __name__ == '__main__':
     filter_string = "event:(asdf) AND status:done"
     # filter_string = "event:(new-image)"
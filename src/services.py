@@ -6,8 +6,9 @@ from aiohttp import web
 from logzero import logger
 
 import rdb_conn
+import request_context
 from auth import requires_auth
-from permissions.permission import perm
+from permissions.compiled import perm
 
 
 def validate_input(string):
@@ -67,6 +68,20 @@ async def db_get_service_conf(service_name):
                                    .get(service_name))
 
 
+async def get_service_conf(request, service_name):
+    """
+    Like :func:`db_get_service_conf`, but fetches the configuration at most
+    once per request.
+
+    :param request: aiohttp request object
+    :param service_name: name of the service to get configuration for
+    :return: service configuration dictionary
+    """
+    return await request_context.memoize(request,
+                                         ('service-conf', service_name),
+                                         db_get_service_conf, service_name)
+
+
 async def db_create_service(service_name, environments, image_name):
     """
     Creates a service configuration in the database
@@ -191,7 +206,6 @@ async def get_running_image(request):
     """
     service_name = request.match_info['name']
     db_res = await db_get_running_image(service_name)
-    print(db_res)
     if db_res:
         img_name = db_res['image-name']
     else:
@@ -210,7 +224,7 @@ async def get_service(request):
         request
     """
     service_name = request.match_info['name']
-    service_conf = await db_get_service_conf(service_name)
+    service_conf = await get_service_conf(request, service_name)
 
     if not service_conf:
         return web.Response(status=404,
@@ -241,7 +255,7 @@ async def resolve_service_create(request):
     :param request: aiohttp request object
     :return: a dictionary containing environments from the request object
     """
-    bod = await request.json()
+    bod = await request_context.body(request)
     return {'env': bod['environments']}
 
 
@@ -251,7 +265,7 @@ async def create_service(request):
     """
     aiohttp endpoint to create a service configuration
     """
-    bod = await request.json()
+    bod = await request_context.body(request)
 
     envs = bod['environments']
     name = bod['service-name']
@@ -291,8 +305,9 @@ async def resolve_service_delete(request):
     :return: dictionary containing placeholder values from the request object
     """
     service_name = request.match_info['name']
-    srvc_conf = await db_get_service_conf(service_name)
-    print(srvc_conf)
+    srvc_conf = await get_service_conf(request, service_name)
+    if not srvc_conf:
+        return {'env': []}
     return {'env': srvc_conf['environments']}
 
 
@@ -303,6 +318,10 @@ async def delete_service(request):
     aiohttp endpoint to delete a service configuration
     """
     service_name = request.match_info['name']
+    if not await get_service_conf(request, service_name):
+        return web.Response(status=404,
+                            text='{"error": "Service is not configured"}',
+                            content_type='application/json')
 
     db_res = await db_delete_service(service_name)
     return web.Response(status=200,
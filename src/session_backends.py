@@ -0,0 +1,131 @@
+import hashlib
+
+import rethinkdb as r
+
+import rdb_conn
+
+
+class MemoryBackend:
+    """
+    Keeps sessions only in the memory of this process. Sessions are lost
+    on restart and are not visible to other API replicas.
+    """
+    name = 'memory'
+    persistent = False
+
+    def key(self, token):
+        return token
+
+    async def save(self, token, session):
+        pass
+
+    async def load(self, token):
+        return None
+
+    async def touch(self, token, accessed):
+        pass
+
+    async def delete(self, token):
+        pass
+
+    async def delete_user(self, username):
+        pass
+
+    async def purge(self, idle_before, created_before):
+        pass
+
+
+class RethinkBackend:
+    """
+    Persists sessions in the *sessions* table, so any API replica can
+    validate any token. Tokens are stored hashed; the primary key of a
+    session is the sha256 digest of its token.
+    """
+    name = 'rethinkdb'
+    persistent = True
+    table = 'sessions'
+
+    def key(self, token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def query(self):
+        return rdb_conn.conn.db().table(self.table)
+
+    async def save(self, token, session):
+        await rdb_conn.conn.run(self.query().insert({
+            'id': self.key(token),
+            'username': session['user']['username'],
+            'created': session['created'],
+            'accessed': session['accessed']
+        }, conflict='replace'))
+
+    async def load(self, token):
+        """
+        :param token: session token
+        :return: the session, with the current user object, or None
+        """
+        users = rdb_conn.conn.db().table('users')
+        row = await rdb_conn.conn.run(
+            self.query().get(self.key(token)).do(
+                lambda session: r.branch(
+                    session.eq(None),
+                    None,
+                    session.merge({'user': users.get(session['username'])})
+                )))
+
+        if not row or not row['user']:
+            return None
+        return {'user': row['user'], 'created': row['created'],
+                'accessed': row['accessed']}
+
+    async def touch(self, token, accessed):
+        await rdb_conn.conn.run(
+            self.query().get(self.key(token)).update({'accessed': accessed}))
+
+    async def delete(self, token):
+        await rdb_conn.conn.run(self.query().get(self.key(token)).delete())
+
+    async def delete_user(self, username):
+        await rdb_conn.conn.run(
+            self.query().get_all(username, index='username').delete())
+
+    async def purge(self, idle_before, created_before):
+        """
+        Deletes every session last used before ``idle_before`` or created
+        before ``created_before``.
+        """
+        await rdb_conn.conn.run(self.query().filter(
+            (r.row['accessed'] < idle_before)
+            | (r.row['created'] < created_before)
+        ).delete())
+
+    async def existing(self, keys):
+        """
+        :param keys: session keys
+        :return: the set of those keys that have a session
+        """
+        if not keys:
+            return set()
+        return set(await rdb_conn.conn.run(
+            self.query().get_all(*keys)['id'].coerce_to('array')))
+
+    async def removed(self):
+        """
+        Yields None once the changefeed is open, then the key of every
+        session deleted by any replica.
+        """
+        query = self.query().changes(include_states=True).filter(
+            lambda change: change.has_fields('state')
+            | change['new_val'].eq(None))
+        async for change in rdb_conn.conn.iter(query):
+            if 'state' in change:
+                if change['state'] == 'ready':
+                    yield None
+                continue
+            yield change['old_val']['id']
+
+
+BACKENDS = {
+    MemoryBackend.name: MemoryBackend,
+    RethinkBackend.name: RethinkBackend,
+}
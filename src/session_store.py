@@ -0,0 +1,411 @@
+import asyncio
+import os
+import sys
+import time
+from collections import OrderedDict, defaultdict
+
+from logzero import logger
+
+from permissions.compiled import flatten
+from session_backends import BACKENDS
+
+BACKEND = os.environ.get('SESSION_BACKEND', 'memory')
+IDLE_TTL = float(os.environ.get('SESSION_IDLE_TTL', str(8 * 60 * 60)))
+MAX_AGE = float(os.environ.get('SESSION_MAX_AGE', str(7 * 24 * 60 * 60)))
+MAX_SESSIONS = int(os.environ.get('SESSION_MAX_SESSIONS', '100000'))
+SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', '60'))
+TOUCH_INTERVAL = float(os.environ.get('SESSION_TOUCH_INTERVAL', '60'))
+MISS_TTL = 5
+MAX_MISSES = 1000
+WATCH_BACKOFF = 1
+WATCH_MAX_BACKOFF = 60
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Approximates the memory used by an object and everything it contains.
+
+    :param obj: object to measure
+    :param seen: ids of objects already counted
+    :return: size in bytes
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(val, seen)
+                    for key, val in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+class SessionStore:
+    """
+    Holds sessions by token. Behaves like a dict for lookups, but sessions
+    expire after ``idle_ttl`` seconds without use or ``max_age`` seconds
+    after they were created, and the least recently used session is evicted
+    when there are more than ``max_sessions``. A background task sweeps out
+    expired sessions every ``sweep_interval`` seconds.
+
+    Sessions are also indexed by username. The user's permission tree is
+    flattened into the *permission-set* of the session whenever the user
+    object is set.
+
+    With a persistent backend the sessions in memory are a read-through
+    cache of the backend: lookups stay in memory, a token that is not
+    cached is loaded with :meth:`load`, and eviction only drops the cached
+    copy. Sessions removed by any replica are dropped from the cache.
+
+    Callbacks added with :meth:`on_remove` are called with the token and
+    session of every session that is removed, for whatever reason. Tasks in
+    the *tasks* list of a removed session are cancelled.
+    """
+
+    def __init__(self, backend=None, idle_ttl=IDLE_TTL, max_age=MAX_AGE,
+                 max_sessions=MAX_SESSIONS, sweep_interval=SWEEP_INTERVAL):
+        self.backend = backend or BACKENDS[BACKEND]()
+        self.idle_ttl = idle_ttl
+        self.max_age = max_age
+        self.max_sessions = max_sessions
+        self.sweep_interval = sweep_interval
+
+        self.sessions = OrderedDict()
+        self.user_tokens = defaultdict(set)
+        self.keys = {}
+        self.misses = OrderedDict()
+        self.remove_callbacks = []
+        self.saving = set()
+        self.sweeper = None
+        self.watcher = None
+        self.evicted = 0
+        self.expired = 0
+
+    def add(self, token, user):
+        """
+        Creates a session for a user. Call :meth:`persist` to store it in
+        the backend.
+
+        :param token: session token
+        :param user: user object
+        :return: the session
+        """
+        now = time.time()
+        return self._cache(token, {'user': user, 'created': now,
+                                   'accessed': now, 'persisted': now})
+
+    async def persist(self, token):
+        """
+        Stores a session in the backend.
+
+        :param token: session token
+        """
+        session = self.sessions.get(token)
+        if session is None:
+            return
+
+        self.saving.add(token)
+        try:
+            await self.backend.save(token, session)
+        finally:
+            self.saving.discard(token)
+
+    async def load(self, token):
+        """
+        Looks up a session, loading it from the backend if it is not in
+        memory.
+
+        :param token: session token
+        :return: the session, or None if there is no live session
+        """
+        session = self.get(token)
+        if session is not None or not self.backend.persistent or not token:
+            return session
+
+        now = time.time()
+        missed = self.misses.get(token)
+        if missed is not None and now - missed < MISS_TTL:
+            return None
+
+        session = await self.backend.load(token)
+        if session is None or self._expired(session, now):
+            self.misses[token] = now
+            self.misses.move_to_end(token)
+            while len(self.misses) > MAX_MISSES:
+                self.misses.popitem(last=False)
+            return None
+
+        self.misses.pop(token, None)
+        session['persisted'] = session['accessed']
+        return self._cache(token, session)
+
+    def _cache(self, token, session):
+        session['permission-set'] = flatten(session['user'].get('permissions'))
+        self.sessions[token] = session
+        self.user_tokens[session['user']['username']].add(token)
+        self.keys[self.backend.key(token)] = token
+
+        while len(self.sessions) > self.max_sessions:
+            oldest = next(iter(self.sessions))
+            logger.debug('Session store full, evicting least recently used '
+                         'session')
+            self.evicted += 1
+            self._evict(oldest)
+
+        if self.sweeper is None or self.sweeper.done():
+            self.sweeper = asyncio.ensure_future(self._sweep())
+        if self.backend.persistent \
+                and (self.watcher is None or self.watcher.done()):
+            self.watcher = asyncio.ensure_future(self._watch())
+
+        return session
+
+    def get(self, token, default=None):
+        """
+        Looks up a session in memory and marks it as used.
+
+        :param token: session token
+        :param default: value to return if there is no live session
+        :return: the session
+        """
+        session = self.sessions.get(token)
+        if session is None:
+            return default
+
+        now = time.time()
+        if self._expired(session, now):
+            self.expired += 1
+            self._remove(token)
+            return default
+
+        session['accessed'] = now
+        self.sessions.move_to_end(token)
+
+        if self.backend.persistent \
+                and now - session['persisted'] > TOUCH_INTERVAL:
+            session['persisted'] = now
+            asyncio.ensure_future(self.backend.touch(token, now))
+
+        return session
+
+    def __getitem__(self, token):
+        session = self.get(token)
+        if session is None:
+            raise KeyError(token)
+        return session
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def pop(self, token, default=None):
+        """
+        Removes a session, from the backend as well.
+
+        :param token: session token
+        :param default: value to return if there is no such session
+        :return: the removed session
+        """
+        if self.backend.persistent and token:
+            asyncio.ensure_future(self.backend.delete(token))
+
+        session = self._remove(token)
+        return default if session is None else session
+
+    def _remove(self, token):
+        session = self._drop(token)
+        if session is None:
+            return None
+
+        for task in session.get('tasks', ()):
+            task.cancel()
+
+        for callback in self.remove_callbacks:
+            try:
+                callback(token, session)
+            except Exception:
+                logger.exception('Session remove callback failed')
+
+        return session
+
+    def _evict(self, token):
+        """
+        Removes a session from memory to make room, while it is still
+        valid. With a persistent backend the session lives on there, so the
+        remove callbacks are not called; otherwise it is gone.
+
+        Expired sessions are removed with :meth:`_remove` instead, which
+        calls the remove callbacks, like when the session is popped.
+        """
+        if self.backend.persistent:
+            self._drop(token)
+        else:
+            self.pop(token)
+
+    def _drop(self, token):
+        session = self.sessions.pop(token, None)
+        if session is None:
+            return None
+
+        self.keys.pop(self.backend.key(token), None)
+        username = session['user']['username']
+        tokens = self.user_tokens.get(username)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.user_tokens[username]
+
+        return session
+
+    def pop_user(self, username):
+        """
+        Removes every session of a user, from the backend as well.
+
+        :param username: username
+        """
+        if self.backend.persistent:
+            asyncio.ensure_future(self.backend.delete_user(username))
+
+        for token in self.tokens_for(username):
+            self._remove(token)
+
+    def evict_user(self, username):
+        """
+        Removes every session of a user from memory, see :meth:`_evict`.
+
+        :param username: username
+        """
+        for token in self.tokens_for(username):
+            self._evict(token)
+
+    def tokens_for(self, username):
+        """
+        :param username: username
+        :return: the tokens of all sessions of the given user
+        """
+        return set(self.user_tokens.get(username, ()))
+
+    def update_user(self, user):
+        """
+        Replaces the user object of every session of a user, without
+        marking the sessions as used.
+
+        :param user: the new user object
+        """
+        tokens = self.user_tokens.get(user['username'], ())
+        if not tokens:
+            return
+
+        perms = flatten(user.get('permissions'))
+        for token in tokens:
+            session = self.sessions[token]
+            session['user'] = user
+            session['permission-set'] = perms
+
+    def on_remove(self, callback):
+        """
+        Adds a callback to call when a session is removed.
+
+        :param callback: function taking a token and a session
+        """
+        self.remove_callbacks.append(callback)
+
+    def _expired(self, session, now):
+        return now - session['accessed'] > self.idle_ttl \
+               or now - session['created'] > self.max_age
+
+    def sweep(self):
+        """
+        Removes all expired sessions from memory, calling the remove
+        callbacks for them. The backend purges them separately.
+
+        :return: number of removed sessions
+        """
+        now = time.time()
+        expired = [token for token, session in self.sessions.items()
+                   if self._expired(session, now)]
+        for token in expired:
+            self._remove(token)
+        self.expired += len(expired)
+        return len(expired)
+
+    async def _sweep(self):
+        while self.sessions:
+            await asyncio.sleep(self.sweep_interval)
+            removed = self.sweep()
+            if removed:
+                logger.info(f'Swept {removed} expired sessions')
+
+            if self.backend.persistent:
+                now = time.time()
+                try:
+                    await self.backend.purge(now - self.idle_ttl,
+                                             now - self.max_age)
+                except Exception as e:
+                    logger.warn(f'Purging expired sessions failed: {e}')
+
+    async def _watch(self):
+        """
+        Removes the sessions other replicas delete from memory. The feed of
+        deleted sessions is reopened, with backoff, when it fails; every
+        time it opens, the sessions in memory are checked against the
+        backend, see :meth:`_revalidate`, to catch up on deletions made
+        while it was not open.
+        """
+        backoff = WATCH_BACKOFF
+        while self.sessions:
+            try:
+                async for key in self.backend.removed():
+                    if key is None:
+                        backoff = WATCH_BACKOFF
+                        await self._revalidate()
+                        continue
+                    token = self.keys.get(key)
+                    if token is not None:
+                        self._remove(token)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warn(f'Session changefeed failed: {e}. Reopening in '
+                            f'{backoff}s.')
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, WATCH_MAX_BACKOFF)
+
+    async def _revalidate(self):
+        """
+        Removes the sessions in memory that the backend no longer has.
+        Sessions still being saved are skipped.
+        """
+        keys = {key: token for key, token in self.keys.items()
+                if token not in self.saving}
+        existing = await self.backend.existing(list(keys))
+        gone = [token for key, token in keys.items() if key not in existing]
+        for token in gone:
+            self._remove(token)
+        if gone:
+            logger.info(f'Removed {len(gone)} sessions deleted while the '
+                        f'session changefeed was not open')
+
+    def stats(self):
+        """
+        :return: a json serializable summary of the store
+        """
+        return {
+            'backend': self.backend.name,
+            'sessions': len(self.sessions),
+            'users': len(self.user_tokens),
+            'max-sessions': self.max_sessions,
+            'idle-ttl': self.idle_ttl,
+            'max-age': self.max_age,
+            'evicted': self.evicted,
+            'expired': self.expired,
+            'memory-bytes': deep_sizeof(self.sessions)
+                            + deep_sizeof(self.user_tokens)
+                            + deep_sizeof(self.keys)
+        }
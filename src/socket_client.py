@@ -0,0 +1,312 @@
+import asyncio
+import itertools
+import json
+import os
+import time
+from collections import deque
+
+import msgpack
+from aiohttp import WSCloseCode
+from logzero import logger
+
+DROP_OLDEST = 'drop-oldest'
+COLLAPSE = 'collapse'
+DISCONNECT = 'disconnect'
+
+POLICIES = (DROP_OLDEST, COLLAPSE, DISCONNECT)
+
+# Types of the frames of a change stream; the client misses changes if one
+# of them is discarded.
+STREAM_FRAMES = ('next', 'batch')
+
+QUEUE_SIZE = int(os.environ.get('WS_QUEUE_SIZE', '256'))
+QUEUE_POLICY = os.environ.get('WS_QUEUE_POLICY', COLLAPSE)
+QUERY_CONCURRENCY = int(os.environ.get('WS_QUERY_CONCURRENCY', '8'))
+
+COMPRESS = os.environ.get('WS_COMPRESS', 'true').lower() == 'true'
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+ENCODERS = {
+    JSON: json.dumps,
+    MSGPACK: lambda data: msgpack.packb(data, use_bin_type=True),
+}
+
+DECODERS = {
+    JSON: json.loads,
+    MSGPACK: lambda data: msgpack.unpackb(data, raw=False),
+}
+
+_ids = itertools.count(1)
+
+
+def negotiate_encoding(request, ws):
+    """
+    Picks the encoding for a websocket. An *encoding* query parameter wins
+    over the negotiated websocket subprotocol. Defaults to json.
+
+    :param request: aiohttp request object
+    :param ws: the prepared websocket response
+    :return: name of the encoding, or None if the requested one is unknown
+    """
+    encoding = request.query.get('encoding') or ws.ws_protocol or JSON
+    return encoding if encoding in ENCODERS else None
+
+
+class Frame:
+    """
+    A frame to send to clients. Each encoding of it is serialized at most
+    once, so the same frame can be queued for any number of clients.
+    """
+    __slots__ = ('data', 'encoded')
+
+    def __init__(self, data):
+        self.data = data
+        self.encoded = {}
+
+    def encode(self, encoding):
+        """
+        :param encoding: name of the encoding
+        :return: the encoded frame; str for json, bytes for msgpack
+        """
+        payload = self.encoded.get(encoding)
+        if payload is None:
+            payload = self.encoded[encoding] = ENCODERS[encoding](self.data)
+        return payload
+
+
+class SocketClient:
+    """
+    Wraps a websocket with a bounded outbound queue drained by a writer
+    task, so a slow client can never make the process buffer without limit.
+
+    When the queue is full, ``policy`` decides what happens:
+
+    - *drop-oldest*: the oldest queued frame is discarded
+    - *collapse*: a queued frame with the same key is removed and the new
+      one is queued at the end, otherwise the oldest queued frame is
+      discarded
+    - *disconnect*: the client is disconnected
+
+    Frames are sent in the order they were queued, so the sequence numbers
+    of a change stream always increase. When a frame of a change stream is
+    discarded, the channel is marked for a resync, see :meth:`resync`, so
+    the client does not take its changes for complete.
+    """
+
+    def __init__(self, ws, request, username=None, encoding=JSON, token=None,
+                 max_size=QUEUE_SIZE, policy=QUEUE_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown websocket queue policy {policy}')
+
+        self.id = next(_ids)
+        self.ws = ws
+        self.remote = request.remote
+        self.username = username
+        self.token = token
+        self.encoding = encoding
+        self.max_size = max_size
+        self.policy = policy
+        self.subscriptions = {}
+        self.tasks = set()
+        self.query_slots = asyncio.Semaphore(QUERY_CONCURRENCY)
+        self.last_seen = time.monotonic()
+
+        self.queue = deque()
+        self.pending = {}
+        self.stale = set()
+        self.wakeup = asyncio.Event()
+        self.dropped = 0
+        self.closed = False
+        self.writer = asyncio.ensure_future(self._write())
+
+    def spawn(self, coro):
+        """
+        Runs a coroutine on behalf of the client. It is cancelled if the
+        client closes before it is done.
+
+        :param coro: the coroutine to run
+        """
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def touch(self):
+        """
+        Marks the client as active.
+        """
+        self.last_seen = time.monotonic()
+
+    @property
+    def idle_for(self):
+        """
+        :return: seconds since the client last sent anything
+        """
+        return time.monotonic() - self.last_seen
+
+    @property
+    def depth(self):
+        """
+        :return: number of frames waiting to be sent
+        """
+        return len(self.queue)
+
+    def decode(self, data):
+        """
+        Decodes a message received from the client.
+
+        :param data: message payload
+        :raises ValueError: if the payload cannot be decoded
+        :return: the decoded message
+        """
+        try:
+            return DECODERS[self.encoding](data)
+        except (TypeError, msgpack.exceptions.UnpackException) as e:
+            raise ValueError(f'Undecodable message: {e}') from e
+
+    def send(self, frame, key=None):
+        """
+        Queues a frame to be sent to the client.
+
+        :param frame: a :class:`Frame`, or json serializable data
+        :param key: key used to collapse frames about the same document,
+            e.g. the channel and primary key of a change
+        """
+        if self.closed:
+            return
+
+        if len(self.queue) >= self.max_size:
+            if self.policy == DISCONNECT:
+                logger.warn(f'Websocket client {self.id} ({self.remote}) is '
+                            f'too slow, disconnecting')
+                self.disconnect(WSCloseCode.TRY_AGAIN_LATER)
+                return
+            if not self._collapse(key):
+                self._drop_oldest()
+
+        entry = [key, frame]
+        self.queue.append(entry)
+        if key is not None:
+            self.pending[key] = entry
+        self.wakeup.set()
+
+
+    def _collapse(self, key):
+        entry = self.pending.get(key) if self.policy == COLLAPSE else None
+        if entry is None:
+            return False
+        del self.pending[key]
+        for index, queued in enumerate(self.queue):
+            if queued is entry:
+                del self.queue[index]
+                break
+        return True
+
+    def _drop_oldest(self):
+        key, frame = entry = self.queue.popleft()
+        if self.pending.get(key) is entry:
+            del self.pending[key]
+        self.dropped += 1
+
+        data = frame.data if isinstance(frame, Frame) else frame
+        if isinstance(data, dict) and data.get('type') in STREAM_FRAMES:
+            self.stale.add(data.get('channel'))
+
+    def resync(self, channel):
+        """
+        Marks a channel for a resync. The writer sends one *resync* frame
+        for it, from the channel's subscription, before the next queued
+        frame, however often the channel is marked until then. The frame
+        takes no room in the queue, so it is never discarded.
+
+        :param channel: the channel of a subscription
+        """
+        if self.closed:
+            return
+        self.stale.add(channel)
+        self.wakeup.set()
+
+    def _resync_frame(self, channel):
+        for subscription in list(self.subscriptions.values()):
+            if subscription.channel == channel:
+                return subscription.position_frame('resync')
+        return None
+
+    async def _write(self):
+        while True:
+            while not self.queue and not self.stale:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+
+            if self.stale:
+                frame = self._resync_frame(self.stale.pop())
+                if frame is None:
+                    continue
+            else:
+                key, frame = entry = self.queue.popleft()
+                if self.pending.get(key) is entry:
+                    del self.pending[key]
+
+            if not isinstance(frame, Frame):
+                frame = Frame(frame)
+            payload = frame.encode(self.encoding)
+
+            try:
+                if isinstance(payload, bytes):
+                    await self.ws.send_bytes(payload)
+                else:
+                    await self.ws.send_str(payload)
+            except Exception as e:
+                logger.debug(f'Websocket client {self.id} write failed: {e}')
+                self.disconnect()
+                return
+
+    def disconnect(self, code=WSCloseCode.GOING_AWAY):
+        """
+        Stops the writer and closes the socket.
+
+        :param code: websocket close code
+        """
+        if self.closed:
+            return
+        self.close()
+        asyncio.ensure_future(self.ws.close(code=code))
+
+    def close(self):
+        """
+        Stops the writer, drops all queued frames and disposes all
+        subscriptions.
+        """
+        self.closed = True
+        self.queue.clear()
+        self.pending.clear()
+        self.stale.clear()
+        if not self.writer.done():
+            self.writer.cancel()
+
+        for task in list(self.tasks):
+            task.cancel()
+
+        subscriptions = list(self.subscriptions.values())
+        self.subscriptions.clear()
+        for subscription in subscriptions:
+            subscription.dispose()
+
+    def stats(self):
+        """
+        :return: a json serializable summary of the client's queue
+        """
+        return {
+            'id': self.id,
+            'remote': self.remote,
+            'username': self.username,
+            'encoding': self.encoding,
+            'subscriptions': sorted(self.subscriptions),
+            'queries': len(self.tasks),
+            'idle': round(self.idle_for, 1),
+            'queue-depth': self.depth,
+            'queue-size': self.max_size,
+            'policy': self.policy,
+            'dropped': self.dropped
+        }
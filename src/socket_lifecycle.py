@@ -0,0 +1,166 @@
+import asyncio
+import json
+import os
+from collections import Counter
+
+from aiohttp import web, WSCloseCode
+from logzero import logger
+
+import auth
+
+HEARTBEAT = float(os.environ.get('WS_HEARTBEAT', '30'))
+IDLE_TIMEOUT = float(os.environ.get('WS_IDLE_TIMEOUT', '600'))
+MAX_CONNECTIONS = int(os.environ.get('WS_MAX_CONNECTIONS', '2000'))
+MAX_CONNECTIONS_PER_USER = int(
+    os.environ.get('WS_MAX_CONNECTIONS_PER_USER', '50'))
+MAX_ANONYMOUS_PER_REMOTE = int(
+    os.environ.get('WS_MAX_ANONYMOUS_PER_REMOTE', '5'))
+
+TOKEN_PROTOCOL = 'token.'
+
+
+def requested_token(request):
+    """
+    Returns the session token of a websocket request. Browsers cannot set
+    headers on websocket requests, so they offer the token as a
+    subprotocol, *token.<token>*, next to the encoding they want, e.g.
+    ``new WebSocket(url, ['json', 'token.' + token])``. Other clients may
+    send the *X-CSRF-Token* header instead. The token is never taken from
+    the url, which ends up in access logs.
+
+    :param request: aiohttp request object
+    :return: the token, or None
+    """
+    protocols = request.headers.get('Sec-WebSocket-Protocol', '')
+    for protocol in protocols.split(','):
+        protocol = protocol.strip()
+        if protocol.startswith(TOKEN_PROTOCOL):
+            return protocol[len(TOKEN_PROTOCOL):]
+    return request.headers.get('X-CSRF-Token')
+
+
+async def identify(request):
+    """
+    Returns the session token of a websocket request, see
+    :func:`requested_token`, and the username of its session.
+
+    :param request: aiohttp request object
+    :return: token and username, or None and None if no valid token was
+        given
+    """
+    token = requested_token(request)
+    session = await auth.find_session(token)
+    if not session:
+        return None, None
+    return token, session['user']['username']
+
+
+class LifecycleManager:
+    """
+    Keeps track of open websocket clients. Enforces a per-process and a
+    per-user connection cap, and a per-remote cap on connections without a
+    session, and reaps clients that have been idle, meaning
+    they have sent nothing and have no subscriptions, for longer than
+    ``idle_timeout`` seconds.
+
+    Half-open connections are detected by the websocket heartbeat, see
+    :data:`HEARTBEAT`.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS,
+                 max_per_user=MAX_CONNECTIONS_PER_USER,
+                 idle_timeout=IDLE_TIMEOUT,
+                 max_anonymous=MAX_ANONYMOUS_PER_REMOTE):
+        self.max_connections = max_connections
+        self.max_per_user = max_per_user
+        self.max_anonymous = max_anonymous
+        self.idle_timeout = idle_timeout
+
+        self.connections = 0
+        self.per_user = Counter()
+        self.anonymous = Counter()
+        self.clients = set()
+        self.reaper = None
+
+    def admit(self, username, remote=None):
+        """
+        Reserves a connection slot for the given user, or, without a user,
+        for the given remote address.
+
+        :param username: username of the connecting user, or None
+        :param remote: remote address of the connection
+        :return: None if admitted, otherwise an aiohttp error response
+        """
+        if self.connections >= self.max_connections:
+            return web.Response(status=503,
+                                text=json.dumps({
+                                    'error': 'Too many websocket '
+                                             'connections'}),
+                                content_type='application/json')
+
+        if username and self.per_user[username] >= self.max_per_user:
+            return web.Response(status=429,
+                                text=json.dumps({
+                                    'error': 'Too many websocket '
+                                             'connections for user'}),
+                                content_type='application/json')
+
+        if not username and self.anonymous[remote] >= self.max_anonymous:
+            return web.Response(status=429,
+                                text=json.dumps({
+                                    'error': 'Too many websocket '
+                                             'connections without a '
+                                             'session'}),
+                                content_type='application/json')
+
+        self.connections += 1
+        if username:
+            self.per_user[username] += 1
+        else:
+            self.anonymous[remote] += 1
+
+    def release(self, username, remote=None):
+        """
+        Frees a connection slot reserved with :meth:`admit`.
+
+        :param username: username the slot was reserved for
+        :param remote: remote address the slot was reserved for
+        """
+        self.connections -= 1
+        counter, key = (self.per_user, username) if username \
+            else (self.anonymous, remote)
+        counter[key] -= 1
+        if counter[key] <= 0:
+            del counter[key]
+
+    def register(self, client):
+        self.clients.add(client)
+        if self.reaper is None or self.reaper.done():
+            self.reaper = asyncio.ensure_future(self._reap())
+
+    def unregister(self, client):
+        self.clients.discard(client)
+
+    async def _reap(self):
+        interval = max(self.idle_timeout / 4, 1)
+        while self.clients:
+            await asyncio.sleep(interval)
+            for client in list(self.clients):
+                if not client.subscriptions \
+                        and client.idle_for > self.idle_timeout:
+                    logger.info(f'Reaping idle websocket client {client.id}')
+                    self.unregister(client)
+                    client.disconnect(WSCloseCode.GOING_AWAY)
+
+    def stats(self):
+        """
+        :return: a json serializable summary of open connections
+        """
+        return {
+            'connections': self.connections,
+            'max-connections': self.max_connections,
+            'max-connections-per-user': self.max_per_user,
+            'max-anonymous-per-remote': self.max_anonymous,
+            'users': dict(self.per_user),
+            'anonymous': sum(self.anonymous.values())
+        }
@@ -0,0 +1,108 @@
+import json
+
+from logzero import logger
+from multidict import CIMultiDict, MultiDict
+
+
+class SocketRequest(dict):
+    """
+    Stands in for an aiohttp request when an endpoint is called over a
+    websocket. Carries the session token of the connection, so the
+    endpoint's ``requires_auth`` check works unchanged.
+
+    Like an aiohttp request it can hold request-scoped values by key.
+    """
+
+    def __init__(self, client, token, query=None, match_info=None,
+                 body=None):
+        super().__init__()
+        self.remote = client.remote
+        self.query = MultiDict(
+            {key: str(val) for key, val in (query or {}).items()})
+        self.match_info = match_info or {}
+        self.headers = CIMultiDict()
+        if token:
+            self.headers['X-CSRF-Token'] = token
+        self.body = body
+
+    async def json(self):
+        return self.body
+
+
+class QueryHandler:
+    """
+    Runs aiohttp endpoints for *query* messages received over a websocket
+    and sends their responses back on the *query* channel, tagged with the
+    id of the query. Queries run concurrently, so responses may arrive in
+    another order than the queries were sent.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+
+    def add(self, name, endpoint):
+        """
+        Makes an endpoint callable over the websocket.
+
+        :param name: name clients use to call the endpoint
+        :param endpoint: aiohttp endpoint function
+        """
+        self.endpoints[name] = endpoint
+
+    def dispatch(self, client, message):
+        """
+        Starts running a query for the given client.
+
+        A query is a dict with *id*, *method* and optionally *query*
+        (query parameters), *path* (path parameters) and *body*. Malformed
+        queries are answered with status 400 right away.
+
+        :param client: the :class:`socket_client.SocketClient` querying
+        :param message: the query
+        """
+        if not isinstance(message, dict):
+            self.respond(client, None, 400,
+                         {'error': 'A query must be an object'})
+            return
+
+        for field in ('query', 'path'):
+            if not isinstance(message.get(field) or {}, dict):
+                self.respond(client, message.get('id'), 400,
+                             {'error': f'{field!r} must be an object'})
+                return
+
+        client.spawn(self.run(client, message))
+
+    async def run(self, client, message):
+        query_id = message.get('id')
+        endpoint = self.endpoints.get(message.get('method'))
+
+        if endpoint is None:
+            self.respond(client, query_id, 404,
+                         {'error': 'No such query method'})
+            return
+
+        request = SocketRequest(client, client.token,
+                                query=message.get('query'),
+                                match_info=message.get('path'),
+                                body=message.get('body'))
+
+        async with client.query_slots:
+            try:
+                response = await endpoint(request)
+            except Exception:
+                logger.exception(f'Websocket query {message.get("method")} '
+                                 f'failed')
+                self.respond(client, query_id, 500,
+                             {'error': 'Internal server error'})
+                return
+
+        body = response.text
+        if body and response.content_type == 'application/json':
+            body = json.loads(body)
+        self.respond(client, query_id, response.status, body)
+
+    @staticmethod
+    def respond(client, query_id, status, body):
+        client.send({"channel": "query", "type": "result", "id": query_id,
+                     "status": status, "message": body})
@@ -1,65 +1,461 @@
+import base64
+import binascii
+import heapq
 import json
+import os
+import time
+from collections import OrderedDict
+from operator import itemgetter
 
 import luqum.parser
 import rethinkdb as r
 from aiohttp import web
 
+import changefeed
+import counts
+import indexes
 import rdb_conn
 import search
 
+COUNT_EXACT = 'exact'
+COUNT_BOUNDED = 'bounded'
+COUNT_NONE = 'none'
+
+COUNT_MODES = (COUNT_EXACT, COUNT_BOUNDED, COUNT_NONE)
+
+COUNT_MODE = os.environ.get('TABLE_COUNT_MODE', COUNT_EXACT)
+COUNT_THRESHOLD = int(os.environ.get('TABLE_COUNT_THRESHOLD', '10000'))
+COUNT_SAMPLE_SIZE = int(os.environ.get('TABLE_COUNT_SAMPLE_SIZE', '1000'))
+
+TOP_K_MAX_DEPTH = int(os.environ.get('TABLE_TOP_K_MAX_DEPTH', '10000'))
+
+# Order of the types of values in rethinkdb; types not listed sort between
+# objects and strings, like binary data.
+TYPE_ORDER = {list: 0, bool: 1, type(None): 2, int: 3, float: 3, dict: 4,
+              str: 6}
+
+PAGE_CACHE_TTL = float(os.environ.get('TABLE_PAGE_CACHE_TTL', '2'))
+PAGE_CACHE_SIZE = int(os.environ.get('TABLE_PAGE_CACHE_SIZE', '256'))
+
+
+class PageCache:
+    """
+    Caches table pages for ``ttl`` seconds, keeping at most ``max_size``
+    pages. The pages of a table are dropped as soon as the table changes;
+    the first page cached for a table subscribes to its changefeed.
+
+    Each table has a generation that is bumped by every change, so a page
+    read while the table changed is not cached.
+    """
+
+    def __init__(self, ttl=PAGE_CACHE_TTL, max_size=PAGE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.pages = OrderedDict()
+        self.feeds = {}
+        self.generations = {}
+
+    def generation(self, table_name):
+        return self.generations.get(table_name, 0)
+
+    def get(self, key):
+        """
+        :param key: key of the page; the table name comes first
+        :return: the cached page, or None
+        """
+        entry = self.pages.get(key)
+        if entry is None:
+            return None
+        cached_at, page = entry
+        if time.monotonic() - cached_at > self.ttl:
+            del self.pages[key]
+            return None
+        self.pages.move_to_end(key)
+        return page
+
+    def put(self, key, page, generation):
+        """
+        Caches a page, unless the table changed since ``generation``.
+
+        :param key: key of the page; the table name comes first
+        :param page: the page
+        :param generation: generation of the table when the page was read
+        """
+        table_name = key[0]
+        if self.ttl <= 0 or generation != self.generation(table_name):
+            return
+
+        if table_name not in self.feeds:
+            self.watch(table_name)
+
+        self.pages[key] = time.monotonic(), page
+        self.pages.move_to_end(key)
+        while len(self.pages) > self.max_size:
+            self.pages.popitem(last=False)
+
+    def invalidate(self, table_name):
+        """
+        Drops every cached page of a table.
+
+        :param table_name: name of the table
+        """
+        self.generations[table_name] = self.generation(table_name) + 1
+        for key in [key for key in self.pages if key[0] == table_name]:
+            del self.pages[key]
+
+    def watch(self, table_name):
+        def on_change(change, seq):
+            self.invalidate(table_name)
+
+        def on_end(error=None):
+            self.feeds.pop(table_name, None)
+            self.invalidate(table_name)
+
+        self.feeds[table_name] = changefeed.hub.subscribe(
+            table_name, on_change, on_end, on_end)
+
+
+page_cache = PageCache()
+
+
+def encode_cursor(sort_value, primary_key_value):
+    """
+    Creates an opaque paging cursor pointing at a row.
+
+    :param sort_value: value of the sort index field of the row
+    :param primary_key_value: primary key of the row
+    :return: url safe cursor string
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps([sort_value, primary_key_value]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    :param cursor: a cursor created by :func:`encode_cursor`
+    :raises ValueError: if the cursor is malformed
+    :return: sort value and primary key of the row the cursor points at
+    """
+    try:
+        sort_value, primary_key_value = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, TypeError, UnicodeDecodeError) as e:
+        raise ValueError(f'Bad cursor: {e}')
+    return sort_value, primary_key_value
+
+
+async def next_cursor(table_name, sort_index, result, has_more):
+    """
+    :return: the cursor of the page after ``result``, or None if it was the
+        last page
+    """
+    if not has_more or not result:
+        return None
+    primary_key = await changefeed.hub.primary_key(table_name)
+    last = result[-1]
+    return encode_cursor(last.get(sort_index), last[primary_key])
+
+
+async def page_query(table_name, plan, cursor, page_start, page_length):
+    """
+    Fetches a page of a search. With a cursor the page starts right after
+    the row the cursor points at, using ``between`` on the index the plan
+    reads, so no rows before the cursor are read; rows with the same sort
+    value are told apart by their primary key, the order the index keeps
+    them in. Without a cursor, ``page_start`` rows are skipped.
+
+    :param table_name: name of the table
+    :param plan: the :class:`search.Plan` of the search
+    :param cursor: cursor of the previous page, an empty string for the
+        first page, or None for offset paging
+    :param page_start: number of rows to skip, without a cursor
+    :param page_length: number of rows in a page
+    :raises ValueError: if the cursor is malformed
+    :return: the rows of the page, and the first row of the next page if
+        there is one
+    """
+    table = rdb_conn.conn.db().table(table_name)
+
+    if cursor:
+        sort_value, key_value = decode_cursor(cursor)
+        primary_key = await changefeed.hub.primary_key(table_name)
+        query = plan.ordered(table, (sort_value, primary_key, key_value))
+    else:
+        query = plan.ordered(table)
+        if cursor is None:
+            query = query.skip(page_start)
+
+    return await rdb_conn.conn.run(
+        query.limit(page_length + 1).coerce_to('array'))
+
+
+def sort_key(value):
+    """
+    :param value: a json value
+    :return: a key ordering values the way rethinkdb orders them
+    """
+    rank = TYPE_ORDER.get(type(value), 5)
+    if rank == 0:
+        return rank, tuple(sort_key(item) for item in value)
+    if rank == 2:
+        return rank, 0
+    if rank == 4:
+        return rank, tuple(sorted((key, sort_key(item))
+                                  for key, item in value.items()))
+    if rank == 5:
+        return rank, str(value)
+    return rank, value
+
+
+class Descending:
+    """
+    A sort key that compares the other way around.
+    """
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+def top_k_depth(cursor, page_start, page_length):
+    """
+    :return: the number of rows :func:`top_k_query` keeps for a page
+    """
+    return page_length + 1 + (page_start if cursor is None else 0)
+
+
+async def top_k_query(table_name, plan, cursor, page_start, page_length):
+    """
+    Fetches a page of a search sorted by a field without an index, which
+    the database cannot sort without loading every row into memory. The
+    matching rows are streamed instead, through a heap keeping the first
+    :func:`top_k_depth` of them in sort order, so memory is proportional
+    to the page, not the table. With a cursor only the rows after it are
+    kept, so deep pages cost no more than the first one.
+
+    Takes the same arguments as :func:`page_query`.
+
+    :raises ValueError: if the cursor is malformed
+    :return: the rows of the page, and the first row of the next page if
+        there is one
+    """
+    table = rdb_conn.conn.db().table(table_name)
+    primary_key = await changefeed.hub.primary_key(table_name)
+    descending = plan.sort_direction is r.desc
+
+    def row_key(row):
+        return sort_key(row.get(plan.sort_index)), \
+               sort_key(row.get(primary_key))
+
+    after = None
+    if cursor:
+        sort_value, key_value = decode_cursor(cursor)
+        after = sort_key(sort_value), sort_key(key_value)
+    if cursor is not None:
+        page_start = 0
+
+    depth = top_k_depth(cursor, page_start, page_length)
+    heap = []
+    async for row in rdb_conn.conn.iter(plan.unordered(table)):
+        key = row_key(row)
+        if after is not None \
+                and not (key < after if descending else after < key):
+            continue
+
+        # The root of the heap is the last of the rows kept.
+        entry = (key if descending else Descending(key)), row
+        if len(heap) < depth:
+            heapq.heappush(heap, entry)
+        elif heap[0][0] < entry[0]:
+            heapq.heapreplace(heap, entry)
+
+    rows = [row for _, row in sorted(heap, key=itemgetter(0), reverse=True)]
+    return rows[page_start:]
+
+
+def known_count(table_name, plan):
+    """
+    Looks up the count of a search in the counts kept in memory by
+    :mod:`counts`. Those are the row counts of tables and of single
+    equality searches, like *status:done*.
+
+    :param table_name: name of the table
+    :param plan: the :class:`search.Plan` of the search
+    :return: the count, or None if it is not known
+    """
+    if not plan.parts:
+        return counts.count(table_name)
+    if len(plan.parts) == 1:
+        found = search.equality(plan.parts[0])
+        if found is not None:
+            return counts.count(table_name, *found)
+    return None
+
+
+async def count_query(table_name, plan, count_mode):
+    """
+    Counts the rows of a table matching a search. Counts kept in memory
+    are used when there are any, see :func:`known_count`. Otherwise the
+    count streams on the server, so it is not bound by the array size
+    limit.
+
+    Count modes:
+
+    - *exact*: count every match
+    - *bounded*: count exactly up to ``COUNT_THRESHOLD`` matches; above
+      that, estimate from the matches in a random sample of
+      ``COUNT_SAMPLE_SIZE`` rows
+    - *none*: do not count; the client can ask for the count in a separate
+      request
+
+    :param table_name: name of the table
+    :param plan: the :class:`search.Plan` of the search
+    :param count_mode: one of :data:`COUNT_MODES`
+    :return: the count, or None, and whether it is exact
+    """
+    table = rdb_conn.conn.db().table(table_name)
+
+    if count_mode == COUNT_NONE:
+        return None, False
+
+    known = known_count(table_name, plan)
+    if known is not None:
+        return known, True
+
+    if not plan.parts:
+        return await rdb_conn.conn.run(table.count()), True
+
+    if count_mode == COUNT_EXACT:
+        return await rdb_conn.conn.run(plan.unordered(table).count()), True
+
+    totals = await rdb_conn.conn.run(r.expr({
+        'matches': plan.unordered(table).limit(COUNT_THRESHOLD + 1).count(),
+        'total': table.count()
+    }))
+    if totals['matches'] <= COUNT_THRESHOLD:
+        return totals['matches'], True
+
+    sampled = await rdb_conn.conn.run(
+        table.sample(COUNT_SAMPLE_SIZE).filter(plan.filter_func).count())
+    sample_size = min(COUNT_SAMPLE_SIZE, totals['total'])
+    estimate = round(totals['total'] * sampled / sample_size)
+    return max(estimate, totals['matches']), False
+
+
+def page_body(response):
+    """
+    Creates the json body of a table page from the response of
+    :func:`table_query`.
+
+    :param response: the response of :func:`table_query`
+    :return: json serializable dictionary
+    """
+    body = {'rows': response['result'],
+            'totalLength': response['count'],
+            'exactCount': response['exact-count'],
+            'hasMore': response['has-more'],
+            'cursor': response['cursor']}
+    if 'plan' in response:
+        body['plan'] = response['plan']
+    return body
+
 
 async def table_query(request, table_name):
-    page_start = int(request.query['pageStart'])
+    """
+    Fetches a page of a table, sorted by an index and filtered by a search
+    term, using the following query params:
+
+    - pageStart: index of the first row, for offset paging
+    - cursor: cursor returned with the previous page, for cursor paging;
+      pass it empty to get the first page. Takes precedence over pageStart
+    - pageLength: length of page
+    - sortIndex: index, or field, to sort by
+    - reverseSort: *true* to sort ascending
+    - searchTerm: lucene search term to filter the query by
+    - countMode: *exact*, *bounded* or *none*, see :func:`count_query`
+    - explain: *true* to add the search plan to the response
+
+    The search is planned by :func:`search.plan`, which reads a range of an
+    index instead of scanning the table where it can. Offset paging reads
+    every skipped row, cursor paging does not. Either way the rows are
+    streamed in index order and reading stops one row after the page,
+    which tells whether there are more.
+
+    A field without a ready index is sorted by :func:`top_k_query`, up to
+    ``TOP_K_MAX_DEPTH`` rows deep.
+
+    Pages are cached for a short while by :data:`page_cache`, so clients
+    polling the same search share one query until the table changes.
+
+    :param request: aiohttp request object
+    :param table_name: name of the table
+    :return: a dictionary with *result*, *count*, *exact-count*, *has-more*,
+        *cursor*, the cursor of the next page, and *plan* if asked for, or
+        with *web-response* if the request is bad
+    """
+    cursor = request.query.get('cursor')
+    page_start = int(request.query.get('pageStart', 0))
     page_length = int(request.query['pageLength'])
     sort_index = request.query['sortIndex']
     if sort_index == '-1':
         sort_index = 'time'
     search_term = request.query['searchTerm']
+    count_mode = request.query.get('countMode', COUNT_MODE)
+
+    if count_mode not in COUNT_MODES:
+        return {
+            'web-response': web.Response(
+                status=400,
+                text=json.dumps({'error': 'Unknown count mode'}),
+                content_type='application/json')
+        }
 
     sort_direction = r.asc \
         if request.query['reverseSort'].lower() == 'true' \
         else r.desc
 
+    explain = request.query.get('explain', '').lower() == 'true'
+    cache_key = (table_name, search.normalize(search_term), sort_index,
+                 sort_direction is r.desc, cursor, page_start, page_length,
+                 count_mode, explain)
+    response = page_cache.get(cache_key)
+    if response is not None:
+        return response
+    generation = page_cache.generation(table_name)
+
     try:
-        filter_func = search.get_filter(search_term)
-        if not filter_func:
-            result = await rdb_conn.conn.run(
-                rdb_conn.conn.db().table(table_name)
-                    .order_by(index=sort_direction(sort_index))
-                    .slice(page_start, page_start + page_length)
-                    .coerce_to('array')
-            )
-
-            count = await rdb_conn.conn.run(
-                rdb_conn.conn.db().table(table_name).count())
-        else:
-            try:
-                db_res = await rdb_conn.conn.run(
-                    rdb_conn.conn.db().table(table_name)
-                        .order_by(index=sort_direction(sort_index))
-                        .filter(filter_func)
-                        .coerce_to('array')
-                        .do(
-                        lambda res: {
-                            'result': res.slice(page_start,
-                                                page_start + page_length),
-                            'length': res.count()
-                        })
-                )
-
-                result = db_res['result']
-                count = db_res['length']
-            except r.errors.ReqlResourceLimitError as e:
-                return {
-                    'web-response': web.Response(
-                        status=400,
-                        text=json.dumps({
-                            'error': 'Unable to sort on given index. Too '
-                                     'many results to sort, due to that the '
-                                     'requested index not being an index in '
-                                     'the database.'}),
-                        content_type='application/json')
-                }
+        plan = await search.plan(search_term, table_name, sort_index,
+                                 sort_direction)
+        indexed = await indexes.is_ready(table_name, sort_index)
+        depth = top_k_depth(cursor, page_start, page_length)
+        if not indexed and depth > TOP_K_MAX_DEPTH:
+            return {
+                'web-response': web.Response(
+                    status=400,
+                    text=json.dumps({
+                        'error': f'{sort_index} is not indexed, pages '
+                                 f'sorted by it can only be '
+                                 f'{TOP_K_MAX_DEPTH} rows deep; use the '
+                                 f'cursor to page further'}),
+                    content_type='application/json')
+            }
+
+        try:
+            query = page_query if indexed else top_k_query
+            rows = await query(table_name, plan, cursor, page_start,
+                               page_length)
+        except ValueError:
+            return {
+                'web-response': web.Response(
+                    status=400,
+                    text=json.dumps({'error': 'Bad cursor'}),
+                    content_type='application/json')
+            }
+
+        count, exact = await count_query(table_name, plan, count_mode)
 
     except luqum.parser.ParseError as e:
         return {
@@ -70,4 +466,18 @@ async def table_query(request, table_name):
                 content_type='application/json')
         }
 
-    return {'result': result, 'count': count}
+    has_more = len(rows) > page_length
+    result = rows[:page_length]
+
+    response = {'result': result, 'count': count, 'exact-count': exact,
+                'has-more': has_more,
+                'cursor': await next_cursor(table_name, sort_index, result,
+                                            has_more)}
+    if explain:
+        response['plan'] = plan.explain()
+        if not indexed:
+            response['plan'].update({'strategy': 'top-k', 'index': None,
+                                     'depth': depth})
+
+    page_cache.put(cache_key, response, generation)
+    return response
@@ -4,9 +4,10 @@ import rethinkdb as r
 from aiohttp import web
 
 import rdb_conn
+import request_context
 import table
 from auth import requires_auth
-from permissions.permission import perm
+from permissions.compiled import perm
 
 
 # -- db request functions --
@@ -69,7 +70,7 @@ async def resolve_task_create(request):
         permission path
     """
 
-    bod = await request.json()
+    bod = await request_context.body(request)
     return {'env': bod['environment']}
 
 
@@ -79,7 +80,7 @@ async def create_task(request):
     """
     aiohttp endpoint to create a task in the database
     """
-    bod = await request.json()
+    bod = await request_context.body(request)
     db_res = await db_create_task(bod['image-name'], bod['environment'],
                                   bod['service-name'])
     return web.Response(status=200,
@@ -93,7 +94,7 @@ async def schedule_deploy(request):
     """
     aiohttp endpoint to schedule a deployment task in the database
     """
-    bod = await request.json()
+    bod = await request_context.body(request)
     db_res = await db_create_scheduled_task(bod['at'], bod['event'],
                                             bod['image-name'],
                                             bod['environment'],
@@ -137,18 +138,16 @@ async def get_tasks(request):
     Gets tasks from the database using the following query params:
 
     - pageStart: starting page
+    - cursor: cursor of the next page, returned with the previous page
     - pageLength: length of page
     - sortIndex: index to sort by
     - searchTerm: lucene search term to filter the query by
+    - countMode: exact, bounded or none
     """
     response = await table.table_query(request, 'tasks')
     if 'web-response' in response:
         return response['web-response']
-    else:
-        result = response['result']
-        count = response['count']
 
     return web.Response(status=200,
-                        text=json.dumps({'rows': result,
-                                         'totalLength': count}),
+                        text=json.dumps(table.page_body(response)),
                         content_type='application/json')
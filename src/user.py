@@ -3,10 +3,12 @@ import json
 import rethinkdb as r
 from aiohttp import web
 
+import api_tokens
 import auth
 import rdb_conn
+import request_context
 from auth import requires_auth
-from permissions.permission import perm
+from permissions.compiled import flatten, perm, permission_set
 
 
 async def db_set_gravatar_email(username, gravatar_email):
@@ -39,9 +41,10 @@ async def db_change_password(username, password):
 
     :param username: username
     :param password: plain-text password to generate hash-information for
+    :raises auth.HashPoolBusy: if the hashing pool is too busy
     :return: database result
     """
-    pw_hash, salt, iters = auth.create_hash(password)
+    pw_hash, salt, iters = await auth.create_hash_async(password)
     return await rdb_conn.conn.run(
         rdb_conn.conn.db().table('users').get(username).update({
             'password_hash': pw_hash,
@@ -103,6 +106,20 @@ def bad_creds_response():
                         content_type='application/json')
 
 
+def api_token_forbidden_response():
+    """
+    Generates an aiohttp response with http status code 403 for endpoints
+    that only a logged in user, not an api token, may call
+
+    :return: the generated response object
+    """
+    return web.Response(status=403,
+                        text=json.dumps({
+                            'error': 'Api tokens cannot be used for this '
+                                     'action'}),
+                        content_type='application/json')
+
+
 @requires_auth
 async def get_permissions(request):
     """
@@ -126,6 +143,35 @@ async def get_permissions(request):
                         content_type='application/json')
 
 
+@requires_auth
+async def check_permissions(request):
+    """
+    aiohttp endpoint to check a list of permission paths for the logged in
+    user in one request.
+
+    The paths come from the *permissions* list in the request body. They
+    are checked against the cached session, without database access.
+    """
+    bod = await request_context.body(request)
+    paths = bod.get('permissions') if isinstance(bod, dict) else None
+
+    if not isinstance(paths, list) \
+            or not all(isinstance(path, str) for path in paths):
+        return web.Response(status=422,
+                            text=json.dumps({
+                                'error': 'permissions must be a list of '
+                                         'permission paths'}),
+                            content_type='application/json')
+
+    perms = permission_set(auth.retrieve_session(request))
+
+    return web.Response(status=200,
+                        text=json.dumps({
+                            'permissions': {path: path in perms
+                                            for path in paths}}),
+                        content_type='application/json')
+
+
 @requires_auth(permission_expr=perm('cion.user.edit'))
 async def set_permissions(request):
     """
@@ -162,13 +208,14 @@ async def set_gravatar_email(request):
 
     Gravatar value comes from the body
     """
+    session = auth.retrieve_session(request)
+    if 'api-token' in session:
+        return api_token_forbidden_response()
+
     bod = await request.json()
     email = bod['gravatar-email']
 
-    token = request.headers.get('X-CSRF-Token')
-
-    db_res = await db_set_gravatar_email(
-        auth.sessions.get(token)['user']['username'], email)
+    db_res = await db_set_gravatar_email(session['user']['username'], email)
 
     if 'errors' in db_res and db_res['errors']:
         return web.Response(status=422,
@@ -219,7 +266,10 @@ async def help_change_password(request_body, username):
                             text=json.dumps({'error': msg}),
                             content_type='application/json')
 
-    db_res = await db_change_password(username, pw)
+    try:
+        db_res = await db_change_password(username, pw)
+    except auth.HashPoolBusy:
+        return auth.busy_response()
     if 'errors' in db_res and db_res['errors']:
         return web.Response(status=422,
                             text=json.dumps({
@@ -227,6 +277,7 @@ async def help_change_password(request_body, username):
                             content_type='application/json')
 
     auth.invalidate_sessions(username)
+    await api_tokens.db_revoke_user_tokens(username)
 
     return web.Response(status=200,
                         text=json.dumps(db_res),
@@ -252,7 +303,11 @@ async def change_own_password(request):
 
     Username comes from the request url.
     """
-    username = auth.retrieve_session(request)['user']['username']
+    session = auth.retrieve_session(request)
+    if 'api-token' in session:
+        return api_token_forbidden_response()
+
+    username = session['user']['username']
     bod = await request.json()
     return await help_change_password(bod, username)
 
@@ -281,6 +336,104 @@ async def delete_user(request):
                             content_type='application/json')
 
     auth.invalidate_sessions(username)
+    await api_tokens.db_revoke_user_tokens(username)
+
+    return web.Response(status=200,
+                        text=json.dumps(db_res),
+                        content_type='application/json')
+
+
+@requires_auth(permission_expr=perm('cion.user.edit'))
+async def create_api_token(request):
+    """
+    aiohttp endpoint to create an api token for CI clients and other
+    scripts.
+
+    Name, permission tree and optionally *expires-in* (seconds) come from
+    the request body. The permission tree may only contain paths the user
+    has. The token is only returned here; it is stored hashed.
+    """
+    session = auth.retrieve_session(request)
+    if 'api-token' in session:
+        return api_token_forbidden_response()
+
+    if not api_tokens.ENABLED:
+        return web.Response(status=503,
+                            text=json.dumps({
+                                'error': 'Api tokens are disabled, '
+                                         'API_TOKEN_KEY is not set'}),
+                            content_type='application/json')
+
+    bod = await request.json()
+    name = bod.get('name')
+    if not name:
+        return web.Response(status=422,
+                            text=json.dumps({
+                                'error': 'Name cannot be empty'}),
+                            content_type='application/json')
+
+    expires_in = bod.get('expires-in')
+    if expires_in is not None and (type(expires_in) is not int
+                                   or expires_in <= 0):
+        return web.Response(status=422,
+                            text=json.dumps({
+                                'error': 'expires-in must be a positive '
+                                         'number of seconds'}),
+                            content_type='application/json')
+
+    permissions = bod.get('permissions', {})
+    if not isinstance(permissions, dict):
+        return web.Response(status=422,
+                            text=json.dumps({
+                                'error': 'permissions must be a permission '
+                                         'tree'}),
+                            content_type='application/json')
+
+    # A token may not grant more than its owner has
+    missing = sorted(flatten(permissions) - permission_set(session))
+    if missing:
+        return auth.forbidden_response(missing)
+
+    token, db_res = await api_tokens.db_create_token(
+        name, session['user']['username'], permissions, expires_in)
+
+    if 'errors' in db_res and db_res['errors']:
+        return web.Response(status=422,
+                            text=json.dumps({
+                                'error': 'Error creating api token'}),
+                            content_type='application/json')
+
+    return web.Response(status=201,
+                        text=json.dumps({'token': token}),
+                        content_type='application/json')
+
+
+@requires_auth(permission_expr=perm('cion.user.edit'))
+async def get_api_tokens(request):
+    """
+    aiohttp endpoint to list all api tokens, without their secrets
+    """
+    db_res = await api_tokens.db_get_tokens()
+
+    return web.Response(status=200,
+                        text=json.dumps(db_res),
+                        content_type='application/json')
+
+
+@requires_auth(permission_expr=perm('cion.user.edit'))
+async def revoke_api_token(request):
+    """
+    aiohttp endpoint to revoke an api token.
+
+    Token id comes from a path parameter in the request url.
+    """
+    db_res = await api_tokens.db_revoke_token(request.match_info['id'])
+
+    if not db_res.get('deleted'):
+        return web.Response(status=404,
+                            text=json.dumps({
+                                'error': 'No api token with that id'}),
+                            content_type='application/json')
 
     return web.Response(status=200,
                         text=json.dumps(db_res),
@@ -1,86 +1,419 @@
-from aiohttp import web
+import asyncio
+import os
+from collections import OrderedDict, defaultdict
+
+import luqum.parser
+from aiohttp import web, WSCloseCode
 from aiohttp.web_ws import MsgType
-from collections import defaultdict
 
 from logzero import logger
 
-from aioreactive.core import subscribe, AsyncAnonymousObserver
+import auth
+import changefeed
+import socket_lifecycle
+from auth import requires_auth
+from documents import json
+from permissions.compiled import perm
+from socket_client import SocketClient, Frame, ENCODERS, JSON, COMPRESS, \
+    negotiate_encoding
+from socket_lifecycle import LifecycleManager
+from socket_rpc import QueryHandler
+
+BATCH_WINDOW = int(os.environ.get('WS_BATCH_WINDOW', '50'))
+BATCH_SIZE = int(os.environ.get('WS_BATCH_SIZE', '100'))
+BATCH_MAX_WINDOW = 5000
+BATCH_MAX_SIZE = 1000
+
+listener: 'WebSocketListener' = None
+
+
+def create(hub):
+    global listener
+    listener = WebSocketListener(hub)
+    return listener
+
+
+def parse_subscription(message):
+    """
+    Reads a *subscribe* message: a table name, or a dict with *table* and
+    optionally *batch*, *search*, *since* and *epoch*.
+
+    :param message: the message
+    :raises ValueError: if the message is malformed; the table name, or
+        None if there is none, is the second argument
+    :return: table, batch, search term, since and epoch
+    """
+    if isinstance(message, str):
+        return message, None, None, None, None
+    if not isinstance(message, dict) or not isinstance(message.get('table'),
+                                                       str):
+        raise ValueError('A subscription needs a table', None)
+
+    table = message['table']
+    batch = message.get('batch')
+    search_term = message.get('search')
+    since = message.get('since')
+    epoch = message.get('epoch')
+
+    if batch is not None:
+        if not isinstance(batch, dict):
+            raise ValueError('batch must be an object', table)
+        for field in ('window', 'size'):
+            if field in batch and type(batch[field]) is not int:
+                raise ValueError(f'batch {field} must be an integer', table)
+    if search_term is not None and not isinstance(search_term, str):
+        raise ValueError('search must be a string', table)
+    if since is not None and type(since) is not int:
+        raise ValueError('since must be an integer', table)
+    if epoch is not None and not isinstance(epoch, str):
+        raise ValueError('epoch must be a string', table)
+
+    return table, batch, search_term, since, epoch
+
+
+def error_frame(table, message):
+    """
+    :param table: name of the table the error is about, or None
+    :param message: the error message
+    :return: an error frame on the table's changefeed channel
+    """
+    channel = f"changefeed-{table}" if table else "changefeed"
+    return {"channel": channel, "type": "error", "message": message}
+
+
+def change_key(change, primary_key):
+    """
+    Returns the primary key value of the document a change is about.
+
+    :param change: changefeed change document
+    :param primary_key: name of the primary key field of the table
+    :return: primary key value, or None
+    """
+    doc = change.get('new_val') or change.get('old_val') or {}
+    return doc.get(primary_key)
+
+
+class ChangeBatcher:
+    """
+    Gathers changes for a time window, or until a number of changes have
+    been gathered, and hands them on as one list. Changes to the same
+    document within a window are squashed into one change.
+    """
+
+    def __init__(self, flush, window=BATCH_WINDOW, size=BATCH_SIZE):
+        self.flush_cb = flush
+        self.window = min(max(window, 1), BATCH_MAX_WINDOW) / 1000
+        self.size = min(max(size, 1), BATCH_MAX_SIZE)
+        self.changes = OrderedDict()
+        self.seq = None
+        self.timer = None
+
+    def add(self, change, key, seq):
+        self.seq = seq
+        if key is None:
+            key = object()
+
+        previous = self.changes.get(key)
+        if previous is not None:
+            change = {'old_val': previous.get('old_val'),
+                      'new_val': change.get('new_val')}
+            if change['old_val'] is None and change['new_val'] is None:
+                # created and deleted within the window
+                del self.changes[key]
+                return
+        self.changes[key] = change
+
+        if len(self.changes) >= self.size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.window,
+                                                             self.flush)
+
+    def flush(self):
+        self.cancel()
+        if self.changes:
+            changes = list(self.changes.values())
+            self.changes.clear()
+            self.flush_cb(changes, self.seq)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+class TableSubscription:
+    """
+    One client's subscription to changes on one table. Changes are sent as
+    one frame each, or, if ``batch`` is given, gathered and sent as array
+    frames. If ``search_term`` is given, only changes to documents matching
+    it are sent.
+
+    Every frame carries the sequence number of its (last) change. A client
+    that reconnects can pass the last sequence number and epoch it got as
+    ``since`` and ``epoch`` to be sent only the changes it missed, or a
+    *resync* frame if those are no longer known.
+
+    :param batch: None, or a dict with *window* (milliseconds) and/or *size*
+        (number of changes)
+    :param search_term: lucene search term filtering the changes
+    :param since: sequence number to resume after
+    :param epoch: epoch of ``since``
+    :param frames: cache of the last frame per feed, shared by subscriptions
+    """
+
+    def __init__(self, hub, client, table, batch=None, on_complete=None,
+                 search_term=None, since=None, epoch=None, frames=None):
+        self.hub = hub
+        self.client = client
+        self.table = table
+        self.channel = f"changefeed-{table}"
+        self.complete_cb = on_complete
+        self.feed_key = changefeed.feed_key(table, search_term)
+        self.frames = {} if frames is None else frames
 
+        self.batcher = None
+        if batch is not None:
+            self.batcher = ChangeBatcher(
+                self.send_batch,
+                window=int(batch.get('window', BATCH_WINDOW)),
+                size=int(batch.get('size', BATCH_SIZE)))
 
-def create(conn):
-    socket = WebSocketListener(conn)
-    return socket.handle_request
+        self.subscription = hub.subscribe(table, self.on_change,
+                                          self.on_error, self.on_complete,
+                                          search_term=search_term)
+        self.resume(search_term, since, epoch)
+
+    def resume(self, search_term, since, epoch):
+        missed = None
+        if since is not None:
+            missed = self.hub.replay(self.table, int(since), epoch, search_term)
+
+        if since is not None and missed is None:
+            self.resync()
+        else:
+            self.send_position("subscribed")
+
+        for seq, change in missed or ():
+            self.on_change(change, seq)
+
+    def position_frame(self, frame_type):
+        """
+        :param frame_type: *subscribed* or *resync*
+        :return: a frame telling the client the epoch and sequence number
+            the subscription is at
+        """
+        return {"channel": self.channel, "type": frame_type,
+                "message": {"epoch": self.hub.epoch,
+                            "seq": self.hub.sequences[self.table]}}
+
+    def send_position(self, frame_type):
+        self.client.send(self.position_frame(frame_type))
+
+    def resync(self):
+        """
+        Tells the client it missed changes, because they are no longer
+        known, and must reload the table.
+        """
+        self.client.resync(self.channel)
+
+    def on_change(self, change, seq):
+        key = change_key(change, self.hub.primary_keys.get(self.table, 'id'))
+        if self.batcher:
+            self.batcher.add(change, key, seq)
+        else:
+            self.client.send(self.frame(change, seq),
+                             key=(self.table, key) if key is not None else None)
+
+    def frame(self, change, seq):
+        """
+        Returns the frame for a change. All subscribers of the same feed
+        share the frame, so each change is encoded once per encoding.
+        """
+        seq_frame = self.frames.get(self.feed_key)
+        if seq_frame is None or seq_frame[0] != seq:
+            frame = Frame({"channel": self.channel, "type": "next", "message": change, "seq": seq})
+            seq_frame = self.frames[self.feed_key] = (seq, frame)
+        return seq_frame[1]
+
+    def send_batch(self, changes, seq):
+        self.client.send({"channel": self.channel, "type": "batch", "message": changes, "seq": seq})
+
+    def on_error(self, error):
+        logger.warn(error)
+        self.on_complete()
+        self.client.send({"channel": self.channel, "type": "error", "message": str(error)})
+
+    def on_complete(self):
+        # The feed is gone, with or without an error; a new feed on the key
+        # numbers its changes anew.
+        self.frames.pop(self.feed_key, None)
+        if self.batcher:
+            self.batcher.flush()
+        if self.complete_cb:
+            self.complete_cb()
+
+    def dispose(self):
+        if self.batcher:
+            self.batcher.cancel()
+        self.subscription.dispose()
+        if self.feed_key not in self.hub.feeds:
+            self.frames.pop(self.feed_key, None)
 
 
 class WebSocketListener:
-    def __init__(self, conn):
-        self.clients = []
-        self.subscriptions = defaultdict(dict)
-        self.conn = conn
+    def __init__(self, hub):
+        self.clients = {}
+        self.hub = hub
+        self.lifecycle = LifecycleManager()
+        self.frames = {}
+        self.queries = QueryHandler()
+        self.token_clients = defaultdict(set)
+
+        auth.sessions.on_remove(self.on_session_removed)
+
+    def on_session_removed(self, token, session):
+        """
+        Disconnects the clients that connected with a session that was
+        removed.
+        """
+        for client in self.token_clients.pop(token, ()):
+            client.disconnect(WSCloseCode.POLICY_VIOLATION)
+
+    def add_query(self, name, endpoint):
+        """
+        Makes an aiohttp endpoint callable on the *query* channel.
+
+        :param name: name clients use to call the endpoint
+        :param endpoint: aiohttp endpoint function
+        """
+        self.queries.add(name, endpoint)
 
     async def handle_request(self, request):
-        ws = web.WebSocketResponse(autoclose=False)
-        await ws.prepare(request)
+        token, username = await socket_lifecycle.identify(request)
+        error = self.lifecycle.admit(username, request.remote)
+        if error:
+            return error
+
+        if request.query.get('encoding', JSON) not in ENCODERS:
+            self.lifecycle.release(username, request.remote)
+            return json({'error': 'Unsupported encoding'}, status=400)
 
-        self.clients.append(ws)
+        ws = web.WebSocketResponse(autoclose=False,
+                                   heartbeat=socket_lifecycle.HEARTBEAT,
+                                   protocols=tuple(ENCODERS),
+                                   compress=COMPRESS)
+        client = None
 
         try:
+            await ws.prepare(request)
+
+            client = SocketClient(ws, request, username,
+                                  negotiate_encoding(request, ws), token)
+            self.clients[ws] = client
+            self.lifecycle.register(client)
+            if token:
+                self.token_clients[token].add(client)
+
             while True:
                 msg = await ws.receive()
                 logger.debug(msg)
-                if msg.type == MsgType.text:
-                    data = msg.json()
+                client.touch()
+                if msg.type in (MsgType.text, MsgType.binary):
+                    try:
+                        data = client.decode(msg.data)
+                    except ValueError:
+                        client.send({"type": "error",
+                                     "message": "Malformed message"})
+                        continue
 
-                    handler = WebSocketListener.dispatch[data['channel']]
-                    await handler(self, ws, data['message'])
+                    handler = WebSocketListener.dispatch.get(
+                        data.get('channel') if isinstance(data, dict)
+                        else None)
+                    if handler is None:
+                        client.send({"type": "error",
+                                     "message": "Unknown channel"})
+                        continue
+                    await handler(self, client, data.get('message'))
                 elif msg.type == MsgType.error:
                     logger.debug('ws connection closed with exception %s' % ws.exception())
-                elif msg.type == MsgType.close:
+                    break
+                elif msg.type in (MsgType.close, MsgType.closing,
+                                  MsgType.closed):
                     break
         except Exception as e:
             logger.exception("Unhandled exception in socket request handler.")
         finally:
             logger.info("Closing websocket.")
-            self.clients.remove(ws)
-
-            for sub in self.subscriptions[ws].values():
-                await sub.adispose()
+            self.lifecycle.release(username, request.remote)
+            self.clients.pop(ws, None)
+            if client:
+                self.lifecycle.unregister(client)
+                client.close()
+                if token in self.token_clients:
+                    self.token_clients[token].discard(client)
+                    if not self.token_clients[token]:
+                        del self.token_clients[token]
 
-            ws.close()
+            await ws.close()
 
         return ws
 
-    async def subscribe(self, ws, message):
-        subs = self.subscriptions[ws]
-        table = message
+    async def subscribe(self, client, message):
+        subs = client.subscriptions
+        try:
+            table, batch, search_term, since, epoch = \
+                parse_subscription(message)
+        except ValueError as e:
+            error, table = e.args
+            client.send(error_frame(table, error))
+            return
 
         if table in subs:
-            logger.debug("Client attempting to subscribe to already subscribed table")
+            logger.debug("Client resubscribing to already subscribed table")
+            subs.pop(table).dispose()
 
-        async def on_change(change):
-            ws.send_json({"channel": f"changefeed-{table}", "type": "next", "message": change})
+        def on_complete():
+            subs.pop(table, None)
 
-        async def on_error(error):
-            logger.warn(error)
-            ws.send_json({"channel": f"changefeed-{table}", "type": "error", "message": str(error)})
-
-        async def on_complete():
-            del subs[table]
-
-        subs[table] = await subscribe(
-            self.conn.observe(message), 
-            AsyncAnonymousObserver(on_change, on_error, on_complete)
-        )
+        try:
+            subs[table] = TableSubscription(self.hub, client, table, batch,
+                                            on_complete, search_term,
+                                            since, epoch, self.frames)
+        except luqum.parser.ParseError as e:
+            client.send(error_frame(table, f"Bad search term: {e}"))
 
-    async def unsubscribe(self, ws, message):
-        subs = self.subscriptions[ws]
-        table = message
+    async def unsubscribe(self, client, message):
+        subs = client.subscriptions
+        table = message.get('table') if isinstance(message, dict) \
+            else message
+        if not isinstance(table, str):
+            client.send(error_frame(None, 'An unsubscription needs a table'))
+            return
 
         if table in subs:
-            await subs[table].adispose()
-            del subs[table]
+            subs.pop(table).dispose()
+
+    async def query(self, client, message):
+        self.queries.dispatch(client, message)
 
     dispatch = {
         "subscribe": subscribe,
         "unsubscribe": unsubscribe,
+        "query": query,
     }
+
+
+@requires_auth(permission_expr=perm('cion.view.config'))
+async def get_clients(request):
+    """
+    aiohttp endpoint listing connected websocket clients, the depth of
+    their outbound queues and the connection caps.
+
+    :param request: aiohttp request object
+    :return: aiohttp response with connection stats and one entry per client
+    """
+    return json({
+        'connections': listener.lifecycle.stats(),
+        'clients': [client.stats() for client in listener.clients.values()]
+    })
@@ -0,0 +1,37 @@
+import pytest
+
+from permissions.compiled import expand, flatten
+from permissions.permission import walk
+
+TREE = {'cion': {'env': {'dev': ['deploy'], 'qa': ['view']}}}
+
+
+def tree_missing(path, values):
+    missing = []
+    allowed = walk(TREE, path.split('.'), [], values, missing.append)
+    return allowed, missing
+
+
+def compiled_missing(path, values):
+    perms = flatten(TREE)
+    missing = [expanded for expanded in expand(path.split('.'), values)
+               if expanded not in perms]
+    return not missing, missing
+
+
+@pytest.mark.parametrize('path, values', [
+    ('cion.env.$env.deploy', {'env': 'dev'}),
+    ('cion.env.$env.deploy', {'env': 'prod'}),
+    ('cion.env.$env.deploy', {'env': ['dev', 'qa', 'prod']}),
+    ('cion.env.$env.view', {'env': ['prod', 'qa', 'test']}),
+    ('cion.user.edit', {}),
+])
+def test_engines_report_the_same_missing_paths(path, values):
+    assert tree_missing(path, values) == compiled_missing(path, values)
+
+
+def test_every_denied_value_is_reported():
+    allowed, missing = tree_missing('cion.env.$env.deploy',
+                                    {'env': ['qa', 'dev', 'prod']})
+    assert not allowed
+    assert missing == ['cion.env.qa.deploy', 'cion.env.prod.deploy']
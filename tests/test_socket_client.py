@@ -0,0 +1,137 @@
+import asyncio
+import json
+
+import pytest
+
+from socket_client import SocketClient, DROP_OLDEST, COLLAPSE, DISCONNECT
+
+CHANNEL = 'changefeed-tasks'
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+
+    async def send_str(self, data):
+        self.sent.append(json.loads(data))
+
+    async def send_bytes(self, data):
+        raise AssertionError('json clients are sent text')
+
+    async def close(self, code=None):
+        self.closed_with = code
+
+
+class FakeRequest:
+    remote = '127.0.0.1'
+
+
+class FakeSubscription:
+    channel = CHANNEL
+
+    def __init__(self):
+        self.seq = 0
+
+    def position_frame(self, frame_type):
+        return {'channel': self.channel, 'type': frame_type,
+                'message': {'epoch': 'e', 'seq': self.seq}}
+
+    def dispose(self):
+        pass
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def client_with(policy, max_size=8):
+    ws = FakeWebSocket()
+    client = SocketClient(ws, FakeRequest(), max_size=max_size,
+                          policy=policy)
+    subscription = FakeSubscription()
+    client.subscriptions['tasks'] = subscription
+    return client, ws, subscription
+
+
+def send_changes(client, subscription, count, keys=1):
+    for seq in range(1, count + 1):
+        subscription.seq = seq
+        client.send({'channel': CHANNEL, 'type': 'next', 'seq': seq},
+                    key=('tasks', seq % keys))
+
+
+async def drain(client):
+    while client.queue or client.stale:
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+
+def sent_seqs(ws):
+    return [frame['seq'] for frame in ws.sent if frame['type'] == 'next']
+
+
+@pytest.mark.parametrize('policy', [DROP_OLDEST, COLLAPSE])
+def test_overflow_sends_one_resync_before_later_frames(policy):
+    client, ws, subscription = client_with(policy)
+
+    # The writer does not get to run, so the queue overflows many times.
+    send_changes(client, subscription, 1000, keys=1000)
+    assert len(client.queue) == client.max_size
+    assert client.stale == {CHANNEL}
+    assert client.dropped == 1000 - client.max_size
+
+    run(drain(client))
+
+    assert ws.sent[0]['type'] == 'resync'
+    assert ws.sent[0]['message']['seq'] == 1000
+    assert [frame['type'] for frame in ws.sent].count('resync') == 1
+    assert sent_seqs(ws) == list(range(1000 - client.max_size + 1, 1001))
+    client.close()
+
+
+def test_collapse_under_pressure_keeps_order():
+    client, ws, subscription = client_with(COLLAPSE, max_size=4)
+
+    send_changes(client, subscription, 20, keys=2)
+
+    # Changes to the two documents collapse into the latest ones, which
+    # stay in sequence order, and nothing is dropped.
+    assert client.dropped == 0
+    run(drain(client))
+    seqs = sent_seqs(ws)
+    assert seqs == sorted(seqs)
+    assert seqs[-2:] == [19, 20]
+    assert not any(frame['type'] == 'resync' for frame in ws.sent)
+    client.close()
+
+
+def test_collapse_only_under_pressure():
+    client, ws, subscription = client_with(COLLAPSE)
+
+    send_changes(client, subscription, 4, keys=1)
+
+    assert [entry[1]['seq'] for entry in client.queue] == [1, 2, 3, 4]
+    client.close()
+
+
+def test_overflow_disconnects():
+    client, ws, subscription = client_with(DISCONNECT)
+
+    send_changes(client, subscription, 1000, keys=1000)
+    run(asyncio.sleep(0))
+
+    assert client.closed
+    assert ws.closed_with is not None
+    assert not client.stale
+
+
+def test_resync_of_unknown_channel_is_skipped():
+    client, ws, subscription = client_with(DROP_OLDEST)
+
+    client.resync('changefeed-gone')
+    client.send({'channel': CHANNEL, 'type': 'next', 'seq': 1})
+    run(drain(client))
+
+    assert [frame['type'] for frame in ws.sent] == ['next']
+    client.close()
@@ -0,0 +1,41 @@
+import pytest
+from multidict import CIMultiDict, MultiDict
+
+pytest.importorskip('async_rethink')
+
+from socket_lifecycle import LifecycleManager, requested_token
+
+
+class FakeRequest:
+    def __init__(self, headers=None, query=None):
+        self.headers = CIMultiDict(headers or {})
+        self.query = MultiDict(query or {})
+
+
+def test_token_from_subprotocol():
+    request = FakeRequest({'Sec-WebSocket-Protocol': 'json, token.abc123'})
+    assert requested_token(request) == 'abc123'
+
+
+def test_token_from_header():
+    request = FakeRequest({'X-CSRF-Token': 'abc123'})
+    assert requested_token(request) == 'abc123'
+
+
+def test_token_not_taken_from_url():
+    request = FakeRequest(query={'token': 'abc123'})
+    assert requested_token(request) is None
+
+
+def test_anonymous_connections_capped_per_remote():
+    lifecycle = LifecycleManager(max_anonymous=2)
+
+    assert lifecycle.admit(None, '10.0.0.1') is None
+    assert lifecycle.admit(None, '10.0.0.1') is None
+    assert lifecycle.admit(None, '10.0.0.1').status == 429
+    assert lifecycle.admit(None, '10.0.0.2') is None
+    assert lifecycle.admit('admin', '10.0.0.1') is None
+
+    lifecycle.release(None, '10.0.0.1')
+    assert lifecycle.admit(None, '10.0.0.1') is None
+    assert lifecycle.connections == 4
@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip('async_rethink')
+
+import rdb_conn  # noqa: F401, imported first to break an import cycle
+from websocket import error_frame, parse_subscription
+
+
+def test_table_name_subscription():
+    assert parse_subscription('tasks') == ('tasks', None, None, None, None)
+
+
+def test_full_subscription():
+    message = {'table': 'tasks', 'batch': {'window': 50, 'size': 10},
+               'search': 'status:done', 'since': 3, 'epoch': 'abc'}
+    assert parse_subscription(message) == (
+        'tasks', {'window': 50, 'size': 10}, 'status:done', 3, 'abc')
+
+
+@pytest.mark.parametrize('message', [{}, 3, None, {'table': 3}])
+def test_subscription_without_table(message):
+    with pytest.raises(ValueError) as e:
+        parse_subscription(message)
+    assert e.value.args[1] is None
+
+
+@pytest.mark.parametrize('message', [
+    {'table': 'tasks', 'since': 'x'},
+    {'table': 'tasks', 'batch': [1]},
+    {'table': 'tasks', 'batch': {'window': '5'}},
+    {'table': 'tasks', 'search': 1},
+    {'table': 'tasks', 'epoch': 1},
+])
+def test_malformed_subscription(message):
+    with pytest.raises(ValueError) as e:
+        parse_subscription(message)
+    assert e.value.args[1] == 'tasks'
+
+
+def test_error_frame_channel():
+    assert error_frame('tasks', 'bad')['channel'] == 'changefeed-tasks'
+    assert error_frame(None, 'bad')['channel'] == 'changefeed'